@@ -4,19 +4,19 @@ import json
 import functools
 from typing import Callable, Optional, Union, Tuple
 
-from channels.generic.websocket import JsonWebsocketConsumer, WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, AsyncWebsocketConsumer
 from django.conf import settings
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
 import logging
 from sentry_sdk import capture_exception, capture_message
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.timezone import now
 import newrelic.agent
-from channels_presence.models import Room
-from channels_presence.models import Presence
 
 from lib import cache
 from lib import channels
+from lib import tunnel_codec
 from .octoprint_messages import process_octoprint_status
 from app.models import *
 from lib.tunnelv2 import OctoprintTunnelV2Helper, TunnelAuthenticationError
@@ -37,7 +37,7 @@ def report_error(
     sentry: bool = True,
     close: bool = False,
 ) -> Callable:
-    """Decorator for consumer message handlers. May close connections on error and reports causes to sentry."""
+    """Decorator for (async) consumer message handlers. May close connections on error and reports causes to sentry."""
 
     # @decorator vs @partial_decorator
     # When decorator is a partial function, we need to handle it differently, as fn comes as an argument.
@@ -47,9 +47,9 @@ def report_error(
     klass = Exception if exc_class is None else exc_class
     def outer(fn):
         @functools.wraps(fn)
-        def inner(self, *args, **kwargs):
+        async def inner(self, *args, **kwargs):
             try:
-                return fn(self, *args, **kwargs)
+                return await fn(self, *args, **kwargs)
             except klass as exc:
                 import traceback
                 traceback.print_exc()
@@ -57,7 +57,7 @@ def report_error(
                 if sentry:
                     capture_exception()
                 if close:
-                    self.close()
+                    await self.close()
                 return
         return inner
     return outer
@@ -67,7 +67,7 @@ close_on_error = functools.partial(report_error, close=True)
 close_on_error.__doc__ = """Reports error and closes consumer connection when specified exception raised"""
 
 
-class WebConsumer(JsonWebsocketConsumer):
+class WebConsumer(AsyncJsonWebsocketConsumer):
 
     def get_printer(self):
         """
@@ -77,14 +77,14 @@ class WebConsumer(JsonWebsocketConsumer):
         """
 
         if 'token' in self.scope['url_route']['kwargs']:
-            return Printer.objects.get(
+            return Printer.objects.select_related('user').get(
                 auth_token=self.scope['url_route']['kwargs']['token'],
             )
 
         if not self.scope['user'].is_authenticated:
             raise Printer.DoesNotExist('session is not authenticated')
 
-        return Printer.objects.get(
+        return Printer.objects.select_related('user').get(
             user=self.scope['user'],
             id=self.scope['url_route']['kwargs']['printer_id']
         )
@@ -92,102 +92,112 @@ class WebConsumer(JsonWebsocketConsumer):
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.printer = None
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        self.accept()
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.web_group_name(self.printer.id),
             self.channel_name
         )
         self.last_touch = time.time()
         self.printer_status_last_sent = 0
+        self.last_printer_data = None
 
-        Room.objects.add(
+        await sync_to_async(channels.add_ws_connection)(
             channels.web_group_name(self.printer.id),
             self.channel_name
         )
 
         # Send printer status to web frontend as soon as it connects
-        self.printer_status(None)
+        await self.printer_status(None)
 
-        touch_user_last_active(self.printer.user)
+        await database_sync_to_async(touch_user_last_active)(self.printer.user)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             "WebConsumer: Closed websocket with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.web_group_name(self.printer.id),
                 self.channel_name
             )
-            Room.objects.remove(
+            await sync_to_async(channels.remove_ws_connection)(
                 channels.web_group_name(self.printer.id),
                 self.channel_name
             )
 
     @newrelic.agent.background_task()
     @report_error
-    def receive_json(self, data, **kwargs):
+    async def receive_json(self, data, **kwargs):
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await sync_to_async(channels.touch_ws_connection)(channels.web_group_name(self.printer.id), self.channel_name)
 
         if not data and time.time() - self.printer_status_last_sent > STATUS_UPDATE_MIN_SECS:
             # Empty message from client is a signal for getting status to trigger a re-render in the client
-            channels.send_status_to_web(self.printer.id)
+            await self.printer_status(None)
 
         if 'passthru' in data:
-            channels.send_msg_to_printer(self.printer.id, data)
+            await channels.send_msg_to_printer_async(self.printer.id, data)
 
     @newrelic.agent.background_task()
     @close_on_error
-    def printer_status(self, data):
-        serializer = PrinterSerializer(
-            Printer.with_archived.get(id=self.printer.id))
-        self.send_json(serializer.data)
+    async def printer_status(self, data):
+        # The printer is serialized once for all the web clients by channels.send_status_to_web.
+        # Serialize it here only when this client needs the status on its own.
+        if data and 'printer' in data:
+            printer_data = self.printer_data(data['printer'])
+            if printer_data == self.last_printer_data:
+                return
+        else:
+            printer_data = self.printer_data(await database_sync_to_async(self.serialize_printer)())
+
+        await self.send_json(printer_data)
+        self.last_printer_data = printer_data
         self.printer_status_last_sent = time.time()
 
+    def serialize_printer(self):
+        return PrinterSerializer(Printer.with_archived.get(id=self.printer.id)).data
+
+    def printer_data(self, serialized_printer):
+        return serialized_printer
+
     @newrelic.agent.background_task()
     @report_error
-    def web_message(self, msg):
-        self.send_json(msg)
+    async def web_message(self, msg):
+        await self.send_json(msg)
 
 
 class SharedWebConsumer(WebConsumer):
 
     def get_printer(self):
-        return SharedResource.objects.select_related('printer').get(
+        return SharedResource.objects.select_related('printer__user').get(
             share_token=self.scope['url_route']['kwargs']['share_token']
         ).printer
 
     @newrelic.agent.background_task()
     @report_error
-    def receive_json(self, data, **kwargs):
+    async def receive_json(self, data, **kwargs):
         # we don't expect frontend sending anything important,
         # this conn is only for status updates from server
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await sync_to_async(channels.touch_ws_connection)(channels.web_group_name(self.printer.id), self.channel_name)
 
-    @newrelic.agent.background_task()
-    @close_on_error
-    def printer_status(self, data):
-        serializer = PublicPrinterSerializer(
-            Printer.with_archived.get(id=self.printer.id)
-        )
-        self.send_json(serializer.data)
+    def printer_data(self, serialized_printer):
+        return dict((k, serialized_printer.get(k)) for k in PublicPrinterSerializer.Meta.fields)
 
     @newrelic.agent.background_task()
     @report_error
-    def web_message(self, msg):
+    async def web_message(self, msg):
         # frontend (should be) interested only in printer_status messages
         pass
 
 
-class OctoPrintConsumer(WebsocketConsumer):
+class OctoPrintConsumer(AsyncWebsocketConsumer):
 
     def get_printer(self):
         headers = dict(self.scope['headers'])
@@ -204,34 +214,31 @@ class OctoPrintConsumer(WebsocketConsumer):
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.connected_at = time.time()
         self.printer = None
 
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        self.accept()
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.octo_group_name(self.printer.id),
             self.channel_name
         )
 
         self.last_touch = self.connected_at
+        self.printer_stale = False
 
-        Room.objects.add(
+        await sync_to_async(channels.add_ws_connection)(
             channels.octo_group_name(self.printer.id),
             self.channel_name
         )
 
         # Send remote status to OctoPrint as soon as it connects
-        self.printer_message({'remote_status': {
-            'viewing': channels.num_ws_connections(
-                channels.web_group_name(self.printer.id)) > 0,
-            'should_watch': self.printer.should_watch(),
-        }})
+        await self.printer_message({'remote_status': await database_sync_to_async(self.remote_status)()})
 
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             channels.octo_group_name(self.printer.id),
             {
                 'type': 'close.duplicates',
@@ -240,24 +247,24 @@ class OctoPrintConsumer(WebsocketConsumer):
             }
         )
 
-        touch_user_last_active(self.printer.user)
+        await database_sync_to_async(touch_user_last_active)(self.printer.user)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             "OctoPrintConsumer: Closed websocket with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.octo_group_name(self.printer.id),
                 self.channel_name
             )
 
-            Room.objects.remove(
+            await sync_to_async(channels.remove_ws_connection)(
                 channels.octo_group_name(self.printer.id),
                 self.channel_name
             )
 
             # disconnect all octoprint tunnels
-            channels.send_message_to_octoprinttunnel(
+            await channels.send_message_to_octoprinttunnel_async(
                 channels.octoprinttunnel_group_name(self.printer.id),
                 {'type': 'octoprint_close', 'ref': 'ALL'},
             )
@@ -265,55 +272,87 @@ class OctoPrintConsumer(WebsocketConsumer):
     @newrelic.agent.background_task()
     @report_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await sync_to_async(channels.touch_ws_connection)(channels.octo_group_name(self.printer.id), self.channel_name)
 
         if text_data:
             data = json.loads(text_data)
         else:
             data = bson.loads(bytes_data)
 
+        # Relayed messages are forwarded right from the event loop. Only status messages need the db.
         if 'janus' in data:
-            channels.send_janus_to_web(
+            await channels.send_janus_to_web_async(
                 self.printer.id, data.get('janus'))
         elif 'http.tunnelv2' in data:
-            cache.octoprinttunnel_http_response_set(
+            await sync_to_async(cache.octoprinttunnel_http_response_set)(
                 data['http.tunnelv2']['ref'],
                 data['http.tunnelv2']
             )
         elif 'ws.tunnel' in data:
-            channels.send_message_to_octoprinttunnel(
+            await channels.send_message_to_octoprinttunnel_async(
                 channels.octoprinttunnel_group_name(self.printer.id),
                 data['ws.tunnel'],
             )
         elif 'passthru' in data:
-            channels.send_message_to_web(self.printer.id, data)
+            await channels.send_message_to_web_async(self.printer.id, data)
         else:
+            await database_sync_to_async(self.process_status)(data)
+
+    def remote_status(self):
+        return {
+            'viewing': channels.num_ws_connections(
+                channels.web_group_name(self.printer.id)) > 0,
+            'should_watch': self.printer.should_watch(),
+        }
+
+    def process_status(self, data):
+        self.refresh_printer_if_stale()
+        process_octoprint_status(self.printer, data)
+
+    def refresh_printer_if_stale(self):
+        # Status messages come every few seconds. The printer is reloaded from db only after it has been changed elsewhere.
+        if self.printer_stale:
+            self.printer_stale = False
             self.printer.refresh_from_db()
-            process_octoprint_status(self.printer, data)
+            # refresh_from_db() keeps related objects, such as current_print, whose id hasn't changed. They may have changed too.
+            for field in self.printer._meta.concrete_fields:
+                if field.is_relation and field.is_cached(self.printer):
+                    field.delete_cached_value(self.printer)
+            return
+
+        # Unlike the printer row, related objects such as printerprediction change all the time. Don't hold on to them.
+        for field in self.printer._meta.related_objects:
+            if field.is_cached(self.printer):
+                field.delete_cached_value(self.printer)
 
     @newrelic.agent.background_task()
     @report_error
-    def printer_message(self, data):
+    async def printer_changed(self, data):
+        self.printer_stale = True
+
+    @newrelic.agent.background_task()
+    @report_error
+    async def printer_message(self, data):
         as_binary = data.get('as_binary', False)
         if as_binary:
-            self.send(text_data=None, bytes_data=bson.dumps(data))
+            await self.send(text_data=None, bytes_data=bson.dumps(data))
         else:
-            self.send(text_data=json.dumps(data))
+            await self.send(text_data=json.dumps(data))
 
     @newrelic.agent.background_task()
     @report_error
-    def close_duplicates(self, data):
+    async def close_duplicates(self, data):
         channel_name = data['channel_name']
         connected_at = data['connected_at']
         if self.channel_name != channel_name and self.connected_at <= connected_at:
             LOGGER.warning(f'closing possibly duplicate connection from printer pk:{self.printer.id}')
-            self.close(code=4321)
+            await self.close(code=4321)
 
 
-class JanusWebConsumer(WebsocketConsumer):
+class JanusWebConsumer(AsyncWebsocketConsumer):
 
     def get_printer(self):
         if 'token' in self.scope['url_route']['kwargs']:
@@ -332,46 +371,46 @@ class JanusWebConsumer(WebsocketConsumer):
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.printer = None
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.janus_web_group_name(self.printer.id),
             self.channel_name
         )
 
-        self.accept('janus-protocol')
+        await self.accept('janus-protocol')
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn("JanusWebConsumer: Closed with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.janus_web_group_name(self.printer.id),
                 self.channel_name
             )
 
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None):
-        channels.send_msg_to_printer(self.printer.id, {'janus': text_data})
+    async def receive(self, text_data=None, bytes_data=None):
+        await channels.send_msg_to_printer_async(self.printer.id, {'janus': text_data})
 
     @newrelic.agent.background_task()
     @report_error
-    def janus_message(self, msg):
-        self.send(text_data=msg.get('msg'))
+    async def janus_message(self, msg):
+        await self.send(text_data=msg.get('msg'))
 
 
 class JanusSharedWebConsumer(JanusWebConsumer):
 
     def get_printer(self):
-        return SharedResource.objects.select_related('printer').get(
+        return SharedResource.objects.select_related('printer__user').get(
             share_token=self.scope['url_route']['kwargs']['share_token']
         ).printer
 
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None):
+    async def receive(self, text_data=None, bytes_data=None):
         # we are going to disable datachannel for shared printer connections
         # by tampering janus offer/answer messages
 
@@ -389,11 +428,11 @@ class JanusSharedWebConsumer(JanusWebConsumer):
                 )
                 return
 
-        channels.send_msg_to_printer(self.printer.id, {'janus': text_data})
+        await channels.send_msg_to_printer_async(self.printer.id, {'janus': text_data})
 
     @newrelic.agent.background_task()
     @report_error
-    def janus_message(self, message):
+    async def janus_message(self, message):
         # we are going to disable datachannel for shared printer connections
         # by tampering janus offer/answer messages
 
@@ -430,10 +469,10 @@ class JanusSharedWebConsumer(JanusWebConsumer):
 
             msg['jsep']['sdp'] = sdp
 
-        self.send(text_data=json.dumps(msg))
+        await self.send(text_data=json.dumps(msg))
 
 
-class OctoprintTunnelWebConsumer(WebsocketConsumer):
+class OctoprintTunnelWebConsumer(AsyncWebsocketConsumer):
 
     # default 1000 does not trigger retries in octoprint webapp
     OCTO_WS_ERROR_CODE = 3000
@@ -450,25 +489,26 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=(Printer.DoesNotExist, TunnelAuthenticationError), sentry=False) # TunnelAuthenticationError: auth error, Printer.DoesNotExist: missing printer/not authorized
-    def connect(self):
+    async def connect(self):
         self.user, self.printer = None, None
         # Exception for un-authenticated or un-authorized access
-        self.user, self.printer = self.get_user_and_printer()
+        self.user, self.printer = await database_sync_to_async(self.get_user_and_printer)()
         if self.printer is None:
-            self.close()
+            await self.close()
             return
 
-        self.accept()
+        await self.accept()
 
         self.path = self.scope['path']
 
         self.ref = str(time.time())
+        self.agent_accepts_codecs = False
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.octoprinttunnel_group_name(self.printer.id),
             self.channel_name,
         )
-        channels.send_msg_to_printer(
+        await channels.send_msg_to_printer_async(
             self.printer.id,
             {
                 'ws.tunnel': {
@@ -476,23 +516,24 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
                     'data': None,
                     'path': self.path,
                     'type': 'connect',
+                    'codecs': tunnel_codec.CODECS,
                 },
                 'as_binary': True,
             })
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             f'OctoprintTunnelWebConsumer: Closed websocket with code: {close_code}')
 
         if not self.printer:
             return
 
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             channels.octoprinttunnel_group_name(self.printer.id),
             self.channel_name,
         )
 
-        channels.send_msg_to_printer(
+        await channels.send_msg_to_printer_async(
             self.printer.id,
             {
                 'ws.tunnel': {
@@ -506,25 +547,33 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
 
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
-        if self.printer.user.tunnel_usage_over_cap():
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        # Only hop to a thread when the cached decision has expired and redis has to be asked again.
+        over_cap = self.printer.user.tunnel_usage_over_cap_cached()
+        if over_cap is None:
+            over_cap = await database_sync_to_async(self.printer.user.tunnel_usage_over_cap)()
+        if over_cap:
             return
 
-        channels.send_msg_to_printer(
+        ws_tunnel = {
+            'ref': self.ref,
+            'data': text_data or bytes_data,
+            'path': self.path,
+            'type': 'tunnel_message',
+        }
+        if self.agent_accepts_codecs:
+            ws_tunnel.update(tunnel_codec.encode(ws_tunnel['data']))
+
+        await channels.send_msg_to_printer_async(
             self.printer.id,
             {
-                'ws.tunnel': {
-                    'ref': self.ref,
-                    'data': text_data or bytes_data,
-                    'path': self.path,
-                    'type': 'tunnel_message',
-                },
+                'ws.tunnel': ws_tunnel,
                 'as_binary': True
             })
 
     @newrelic.agent.background_task()
     @report_error
-    def octoprinttunnel_message(self, msg, **kwargs):
+    async def octoprinttunnel_message(self, msg, **kwargs):
         # msg == {'data': {'type': ..., 'data': ..., 'ref': ...}, ...}
         payload = msg['data']
 
@@ -532,12 +581,17 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
             return
 
         if payload['type'] == 'octoprint_close':
-            self.close(self.OCTO_WS_ERROR_CODE)
+            await self.close(self.OCTO_WS_ERROR_CODE)
             return
 
-        if isinstance(payload['data'], bytes):
-            self.send(bytes_data=payload['data'])
+        # Frames stay compressed all the way through the channel layer, and are accounted at their compressed size
+        if 'codec' in payload:
+            self.agent_accepts_codecs = True
+        data = tunnel_codec.decode(payload)
+
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
         else:
-            self.send(text_data=payload['data'])
+            await self.send(text_data=data)
 
-        cache.octoprinttunnel_update_stats(self.printer.user_id, len(payload['data']))
+        cache.octoprinttunnel_update_stats(self.printer.user_id, len(payload['data']))  # Only accumulated in process. No I/O
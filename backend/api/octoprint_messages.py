@@ -24,7 +24,7 @@ def process_octoprint_status(printer: Printer, msg: Dict) -> None:
         if agent_name != printer.agent_name or agent_version != printer.agent_version:
             printer.agent_name = agent_name
             printer.agent_version = agent_version
-            printer.save()
+            printer.save(update_fields=['agent_name', 'agent_version', 'updated_at'])
 
 
     # Backward compatibility: octoprint_data is for OctoPrint-Obico 2.1.2 or earlier, or moonraker-obico 0.5.1 or earlier
@@ -33,7 +33,7 @@ def process_octoprint_status(printer: Printer, msg: Dict) -> None:
     if not printer_status:
         cache.printer_status_delete(printer.id)
     elif (printer_status or {}).get('_ts'):   # data format for plugin 1.6.0 and higher
-        cache.printer_status_set(printer.id, json.dumps((printer_status or {})), ex=STATUS_TTL_SECONDS)
+        cache.printer_status_doc_set(printer.id, printer_status, ex=STATUS_TTL_SECONDS)
     else: # TODO: retire this part after 7/1/2023
         octoprint_data: Dict = dict()
         set_as_str_if_present(octoprint_data, (printer_status or {}), 'state')
@@ -149,4 +149,4 @@ def update_print_stats_if_needed(printer_status, _print):
             print_obj_dirty = True
 
     if print_obj_dirty:
-        _print.save()
\ No newline at end of file
+        _print.save(update_fields=['print_time', 'filament_used', 'updated_at'])
\ No newline at end of file
@@ -12,13 +12,9 @@ from rest_framework.throttling import AnonRateThrottle
 from rest_framework import viewsets, mixins
 from rest_framework import status
 from django.conf import settings
-from django.core import serializers
-from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.exceptions import ImproperlyConfigured
 from django.http import Http404
-import requests
 import json
-import io
 import os
 import logging
 from ipware import get_client_ip
@@ -32,17 +28,17 @@ from .printer_discovery import (
 from .authentication import PrinterAuthentication
 from lib.file_storage import save_file_obj
 from lib import cache
-from lib.image import overlay_detections
-from lib.utils import ml_api_auth_headers
-from lib.utils import save_pic, get_rotated_pic_url
+from lib.image import cap_image_size
+from lib.utils import ml_api_detect
+from lib.utils import save_pic, get_rotated_pic_url, tagged_pic_url
 from app.models import Printer, PrinterPrediction, OneTimeVerificationCode, PrinterEvent, GCodeFile
 from notifications.handlers import handler
-from lib.prediction import update_prediction_with_detections, is_failing, VISUALIZATION_THRESH
-from lib.channels import send_status_to_web
+from lib.prediction import update_prediction_with_detections, is_failing, prediction_snapshot, VISUALIZATION_THRESH
+from lib.channels import send_status_to_web, send_printer_changed_to_printer
 from config.celery import celery_app
 from .serializers import VerifyCodeInputSerializer, OneTimeVerificationCodeSerializer, GCodeFileSerializer
 
-from PIL import Image, ImageFile
+from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 LOGGER = logging.getLogger(__name__)
@@ -100,63 +96,66 @@ class OctoPrintPicView(APIView):
         pic_path = f'raw/{printer.id}/{printer.current_print.id}/{pic_id}.jpg'
         internal_url, external_url = save_file_obj(pic_path, pic, settings.PICS_CONTAINER, long_term_storage=False)
 
-        img_url_updated = self.detect_if_needed(printer, pic, pic_id, internal_url)
+        if settings.PIC_DETECTION_ASYNC and printer.should_watch() and printer.actively_printing():
+            # The raw pic is shown right away. The detection worker replaces it with the tagged pic, and notifies web clients again
+            cache.printer_pic_set(printer.id, {'img_url': external_url}, ex=IMG_URL_TTL_SECONDS)
+            send_status_to_web(printer.id)
+            celery_app.send_task(
+                'app.tasks.detect_pic',
+                args=(printer.id, printer.current_print.id, pic_id, internal_url, external_url),
+                expires=settings.MIN_DETECTION_INTERVAL * 3,  # A stale frame is not worth detecting
+            )
+            return Response({'result': 'ok'})
+
+        img_url_updated = detect_if_needed(printer, pic, pic_id, internal_url)
         if not img_url_updated:
             cache.printer_pic_set(printer.id, {'img_url': external_url}, ex=IMG_URL_TTL_SECONDS)
 
         send_status_to_web(printer.id)
         return Response({'result': 'ok'})
 
-    def detect_if_needed(self, printer, pic, pic_id, raw_pic_url):
-        '''
-        Return:
-           True: Detection was performed. img_url was updated to the tagged image
-           False: No detection was performed. img_url was not updated
-        '''
 
-        if not printer.should_watch() or not printer.actively_printing():
-            return False
+@cache.memoization_scope('detect_if_needed')
+def detect_if_needed(printer, pic, pic_id, raw_pic_url):
+    '''
+    Return:
+       True: Detection was performed. img_url was updated to the tagged image
+       False: No detection was performed. img_url was not updated
+    '''
 
-        prediction, _ = PrinterPrediction.objects.get_or_create(printer=printer)
+    if not printer.should_watch() or not printer.actively_printing():
+        return False
 
-        if time.time() - prediction.updated_at.timestamp() < settings.MIN_DETECTION_INTERVAL:
-            return False
+    prediction, _ = PrinterPrediction.objects.get_or_create(printer=printer)
 
-        cache.print_num_predictions_incr(printer.current_print.id)
+    if time.time() - prediction.updated_at.timestamp() < settings.MIN_DETECTION_INTERVAL:
+        return False
 
-        req = requests.get(settings.ML_API_HOST + '/p/', params={'img': raw_pic_url}, headers=ml_api_auth_headers(), verify=False)
-        req.raise_for_status()
-        detections = req.json()['detections']
+    cache.print_num_predictions_incr(printer.current_print.id)
 
-        update_prediction_with_detections(prediction, detections)
-        prediction.save()
+    pic.seek(0)
+    detections = ml_api_detect(img_bytes=pic.read(), img_url=raw_pic_url)
 
-        if prediction.current_p > settings.THRESHOLD_LOW * 0.2:  # Select predictions high enough for focused feedback
-            cache.print_high_prediction_add(printer.current_print.id, prediction.current_p, pic_id)
+    update_prediction_with_detections(prediction, detections)
+    prediction.save()
 
-        pic.file.seek(0)  # Reset file object pointer so that we can load it again
-        tagged_img = io.BytesIO()
-        detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
-        overlay_detections(Image.open(pic), detections_to_visualize).save(tagged_img, "JPEG")
-        tagged_img.seek(0)
+    if prediction.current_p > settings.THRESHOLD_LOW * 0.2:  # Select predictions high enough for focused feedback
+        cache.print_high_prediction_add(printer.current_print.id, prediction.current_p, pic_id)
 
-        pic_path = f'tagged/{printer.id}/{printer.current_print.id}/{pic_id}.jpg'
-        _, external_url = save_file_obj(pic_path, tagged_img, settings.PICS_CONTAINER, long_term_storage=False)
-        cache.printer_pic_set(printer.id, {'img_url': external_url}, ex=IMG_URL_TTL_SECONDS)
+    # The tagged pic is rendered from the raw pic and the detections when it's requested
+    detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
+    cache.print_prediction_append(printer.current_print.id, pic_id, prediction_snapshot(prediction), detections_to_visualize)
+    tagged_url = tagged_pic_url(printer.id, printer.current_print.id, pic_id)
+    cache.printer_pic_set(printer.id, {'img_url': tagged_url}, ex=IMG_URL_TTL_SECONDS)
 
-        prediction_json = serializers.serialize("json", [prediction, ])
-        p_out = io.BytesIO()
-        p_out.write(prediction_json.encode('UTF-8'))
-        p_out.seek(0)
-        save_file_obj(f'p/{printer.id}/{printer.current_print.id}/{pic_id}.json', p_out, settings.PICS_CONTAINER, long_term_storage=False)
+    if is_failing(prediction, printer.detective_sensitivity, escalating_factor=settings.ESCALATING_FACTOR):
+        # The prediction is high enough to match the "escalated" level and hence print needs to be paused
+        pause_if_needed(printer, tagged_url)
+    elif is_failing(prediction, printer.detective_sensitivity, escalating_factor=1):
+        alert_if_needed(printer, tagged_url)
 
-        if is_failing(prediction, printer.detective_sensitivity, escalating_factor=settings.ESCALATING_FACTOR):
-            # The prediction is high enough to match the "escalated" level and hence print needs to be paused
-            pause_if_needed(printer, external_url)
-        elif is_failing(prediction, printer.detective_sensitivity, escalating_factor=1):
-            alert_if_needed(printer, external_url)
+    return True
 
-        return True
 
 class OctoPrinterView(APIView):
     authentication_classes = (PrinterAuthentication,)
@@ -179,6 +178,7 @@ class OctoPrinterView(APIView):
 
     def patch(self, request):
         Printer.objects.filter(id=request.auth.id).update(**request.data)
+        send_printer_changed_to_printer(request.auth.id)  # update() doesn't send post_save
         return self.get_response(request.auth, request.user)
 
 
@@ -226,25 +226,6 @@ def pause_if_needed(printer, img_url):
     send_failure_alert(printer, img_url, is_warning=False, print_paused=printer_paused)
 
 
-def cap_image_size(pic):
-    im = Image.open(pic.file)
-    if max(im.size) <= 1296:
-        pic.file.seek(0)
-        return pic
-
-    im.thumbnail((1280, 960), Image.ANTIALIAS)
-    output = io.BytesIO()
-    im.save(output, format='JPEG')
-    output.seek(0)
-    return InMemoryUploadedFile(
-        output,
-        u"pic",
-        'pic',
-        pic.content_type,
-        len(output.getbuffer()),
-        None)
-
-
 class OctoPrinterDiscoveryView(APIView):
     throttle_classes = [AnonRateThrottle]
 
@@ -7,6 +7,7 @@ from django.utils.timezone import now
 from pushbullet import Pushbullet, PushbulletError
 import phonenumbers
 import json
+from django.db import models
 
 from app.models import (
     User, Print, Printer, GCodeFile, PrintShotFeedback, PrinterPrediction, MobileDevice, OneTimeVerificationCode,
@@ -112,6 +113,18 @@ class PrintSerializer(BasePrintSerializer):
         return reverse('Print-prediction-json', kwargs={'pk': obj.pk})
 
 
+class PrinterListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # Load what's in redis for all the printers in one round trip
+        printers = list(data.all() if isinstance(data, models.Manager) else data)
+        Printer.prefetch_cache_snapshot(printers)
+        try:
+            return super().to_representation(printers)
+        finally:
+            Printer.clear_cache_snapshot(printers)
+
+
 class PrinterSerializer(BasePrinterSerializer):
     pic = serializers.DictField(read_only=True)
     status = serializers.DictField(read_only=True)
@@ -123,6 +136,17 @@ class PrinterSerializer(BasePrinterSerializer):
         model = Printer
         fields = BasePrinterSerializer.Meta.fields + ('pic', 'status', 'settings', 'current_print','normalized_p',)
         read_only_fields = BasePrinterSerializer.Meta.read_only_fields + ('pic', 'status', 'settings', 'current_print', 'normalized_p',)
+        list_serializer_class = PrinterListSerializer
+
+    def to_representation(self, instance):
+        if hasattr(instance, '_cache_snapshot'):  # Prefetched by PrinterListSerializer
+            return super().to_representation(instance)
+
+        Printer.prefetch_cache_snapshot([instance])
+        try:
+            return super().to_representation(instance)
+        finally:
+            Printer.clear_cache_snapshot([instance])
 
     def get_normalized_p(self, obj: Printer) -> float:
         return calc_normalized_p(obj.detective_sensitivity, obj.printerprediction) if hasattr(obj, 'printerprediction') else 0
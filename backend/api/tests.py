@@ -1,4 +1,5 @@
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.conf import settings
 from unittest.mock import *
 from django.utils import timezone
 from datetime import timedelta
@@ -9,6 +10,18 @@ from safedelete.models import *
 from app.models import Printer, Print, User
 from api.octoprint_views import *
 from api.octoprint_messages import process_octoprint_status
+from app.views.tunnelv2_views import _tunnel_response_messages, _tunnel_response_content, TunnelResponseIncomplete
+from api.consumers import OctoprintTunnelWebConsumer
+from asgiref.sync import async_to_sync
+from app.tasks import compile_timelapse
+from lib import cache, tunnel_codec
+from PIL import Image
+import io
+import json
+import os
+import shutil
+import tempfile
+import zlib
 
 
 def init_data():
@@ -384,3 +397,232 @@ class PrintTestCase(TestCase):
         process_octoprint_status(self.printer, status_msg_without_event(100, '1.gcode'))
         celery_app.send_task.assert_has_calls(EVENT_CALLS)
         self.assertEqual(celery_app.send_task.call_count, 1)
+
+
+def chunked_response(content, num_chunks, compressed=True):
+    body = zlib.compress(content) if compressed else content
+    size = len(body) // num_chunks + 1
+    pieces = [body[i * size:(i + 1) * size] for i in range(num_chunks)]
+    msgs = [{'ref': 'ref', 'seq': seq, 'content': piece, 'eof': seq == num_chunks - 1} for (seq, piece) in enumerate(pieces)]
+    msgs[0]['response'] = {'status': 200, 'headers': {}, 'cookies': [], 'compressed': compressed}
+    return msgs
+
+
+@patch('lib.cache.octoprinttunnel_update_stats')
+@patch('app.views.tunnelv2_views.dispatcher')
+class TunnelResponseTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.user = Mock(id=1)
+        self.content = b''.join(f'line {i}\n'.encode() for i in range(2000))
+
+    def stream(self, dispatcher, reads):
+        dispatcher.queued_secs.return_value = 0
+        dispatcher.read.side_effect = reads
+        messages = _tunnel_response_messages('ref')
+        first = next(messages, None)
+        return b''.join(_tunnel_response_content(self.user, first, messages))
+
+    def test_chunks_in_order(self, dispatcher, update_stats):
+        msgs = chunked_response(self.content, 4)
+        self.assertEqual(self.stream(dispatcher, [msgs[:1], msgs[1:3], msgs[3:]]), self.content)
+        dispatcher.end.assert_called_once_with('ref')
+        update_stats.assert_called_once_with(1, len(self.content))
+
+    def test_uncompressed_chunks(self, dispatcher, update_stats):
+        msgs = chunked_response(self.content, 3, compressed=False)
+        self.assertEqual(self.stream(dispatcher, [msgs]), self.content)
+
+    def test_not_started_in_time(self, dispatcher, update_stats):
+        dispatcher.queued_secs.return_value = 0
+        dispatcher.read.side_effect = [[]]
+        self.assertIsNone(next(_tunnel_response_messages('ref'), None))
+        dispatcher.end.assert_called_once_with('ref')
+
+    def test_timed_out_waiting_for_chunk(self, dispatcher, update_stats):
+        msgs = chunked_response(self.content, 4)
+        with self.assertRaises(TunnelResponseIncomplete):
+            self.stream(dispatcher, [msgs[:2], []])
+        dispatcher.end.assert_called_once_with('ref')
+
+    def test_chunk_out_of_order(self, dispatcher, update_stats):
+        msgs = chunked_response(self.content, 4)
+        with self.assertRaises(TunnelResponseIncomplete):
+            self.stream(dispatcher, [msgs[:1], [msgs[2]]])
+        dispatcher.end.assert_called_once_with('ref')
+
+    def test_zlib_stream_truncated(self, dispatcher, update_stats):
+        msgs = chunked_response(self.content, 4)
+        msgs[2]['eof'] = True
+        with self.assertRaises(TunnelResponseIncomplete):
+            self.stream(dispatcher, [msgs[:3]])
+
+
+class OctoprintTunnelWebConsumerCodecTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.consumer = OctoprintTunnelWebConsumer({'type': 'websocket', 'path': '/ws/octoprint/1/sockjs/websocket'})
+        self.consumer.printer = Mock(id=1, user_id=1)
+        self.consumer.printer.user.tunnel_usage_over_cap_cached.return_value = False
+        self.consumer.ref = 'ref'
+        self.consumer.path = '/sockjs/websocket'
+        self.consumer.agent_accepts_codecs = False
+
+        self.to_printer = []
+        self.to_browser = []
+
+        async def send_msg_to_printer_async(printer_id, msg):
+            self.to_printer.append(msg['ws.tunnel'])
+
+        async def send(text_data=None, bytes_data=None, **kwargs):
+            self.to_browser.append(text_data or bytes_data)
+
+        patcher = patch('api.consumers.channels.send_msg_to_printer_async', send_msg_to_printer_async)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer.send = send
+
+        patcher = patch('api.consumers.cache.octoprinttunnel_update_stats')
+        self.update_stats = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def from_agent(self, **payload):
+        payload.update({'ref': 'ref', 'type': 'tunnel_message'})
+        async_to_sync(self.consumer.octoprinttunnel_message)({'data': payload})
+
+    def test_old_agent_gets_frames_uncompressed(self):
+        self.from_agent(data='a' * 1000)
+        async_to_sync(self.consumer.receive)(text_data='b' * 1000)
+
+        self.assertEqual(self.to_browser, ['a' * 1000])
+        self.assertEqual(self.to_printer[0]['data'], 'b' * 1000)
+        self.assertNotIn('codec', self.to_printer[0])
+
+    def test_agent_accepting_codecs_gets_frames_compressed(self):
+        self.from_agent(data='a', codec=None)
+        async_to_sync(self.consumer.receive)(text_data='b' * 1000)
+        async_to_sync(self.consumer.receive)(bytes_data=b'c' * 1000)
+
+        self.assertEqual(self.to_printer[0]['codec'], 'zlib')
+        self.assertEqual(tunnel_codec.decode(self.to_printer[0]), 'b' * 1000)
+        self.assertEqual(tunnel_codec.decode(self.to_printer[1]), b'c' * 1000)
+
+    def test_compressed_agent_frames_are_decompressed_for_browser(self):
+        msg = tunnel_codec.encode('a' * 1000)
+        self.from_agent(**msg)
+        msg = tunnel_codec.encode(b'b' * 1000)
+        self.from_agent(**msg)
+
+        self.assertEqual(self.to_browser, ['a' * 1000, b'b' * 1000])
+        self.update_stats.assert_called_with(1, len(msg['data']))
+
+
+@patch('app.tasks.save_file_obj')
+@patch('app.tasks.close_ffmpeg_pipe')
+@patch('app.tasks.ffmpeg_from_pipe')
+@patch('app.models.celery_app')
+class CompileTimelapseTestCase(TestCase):
+
+    pic_ids = ('1000', '1010', '1020')
+
+    def setUp(self):
+        (self.user, self.printer, _) = init_data()
+        self.print = self.printer.current_print
+
+        self.media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.addCleanup(cache.print_predictions_delete, self.print.id)
+
+        for pic_id in self.pic_ids:
+            out = io.BytesIO()
+            Image.new('RGB', (64, 48), 'red').save(out, 'JPEG')
+            self.write_file(f'raw/{self.printer.id}/{self.print.id}/{pic_id}.jpg', out.getvalue())
+
+        self.ffmpegs = {}
+        self.saved = {}
+
+    def write_file(self, path, content):
+        fqp = os.path.join(self.media_root, settings.PICS_CONTAINER, path)
+        os.makedirs(os.path.dirname(fqp), exist_ok=True)
+        with open(fqp, 'wb') as f:
+            f.write(content)
+
+    def fake_ffmpeg(self, ffmpeg_from_pipe, save_file_obj):
+        def ffmpeg(output_mp4, input_codec, extra_options):
+            open(output_mp4, 'wb').close()
+            proc = self.ffmpegs[input_codec] = Mock(stdin=io.BytesIO())
+            proc.poll.return_value = 0
+            return proc
+
+        def save(dest_path, file_obj, container):
+            self.saved[dest_path] = file_obj.read()
+            return ('internal', f'https://example.com/{dest_path}')
+
+        ffmpeg_from_pipe.side_effect = ffmpeg
+        save_file_obj.side_effect = save
+
+    def test_predictions_from_series_without_p_dir(self, celery_app, ffmpeg_from_pipe, close_ffmpeg_pipe, save_file_obj):
+        self.fake_ffmpeg(ffmpeg_from_pipe, save_file_obj)
+        for (i, pic_id) in enumerate(self.pic_ids):
+            cache.print_prediction_append(self.print.id, pic_id, (i, i, 0.1, 0.1, 0.1, 0.1), [['failure', 0.5, [32, 24, 10, 10]]])
+
+        compile_timelapse(self.print.id)
+
+        self.print.refresh_from_db()
+        self.assertEqual(self.print.video_url, f'https://example.com/private/{self.print.id}.mp4')
+        self.assertEqual(self.print.tagged_video_url, f'https://example.com/private/{self.print.id}_tagged.mp4')
+        self.assertTrue(self.ffmpegs['ppm'].stdin.getvalue().startswith(b'P6'))
+        prediction_json = json.loads(self.saved[f'private/{self.print.id}_p.json'])
+        self.assertEqual([p['fields']['current_frame_num'] for p in prediction_json], [0, 1, 2])
+        self.assertEqual(cache.print_predictions_get(self.print.id), {})
+
+    def test_no_predictions_without_p_dir(self, celery_app, ffmpeg_from_pipe, close_ffmpeg_pipe, save_file_obj):
+        self.fake_ffmpeg(ffmpeg_from_pipe, save_file_obj)
+
+        compile_timelapse(self.print.id)
+
+        self.print.refresh_from_db()
+        self.assertEqual(self.print.video_url, f'https://example.com/private/{self.print.id}.mp4')
+        self.assertIsNone(self.print.tagged_video_url)
+        self.assertNotIn('ppm', self.ffmpegs)
+
+    def test_legacy_tagged_pics_and_p_jsons(self, celery_app, ffmpeg_from_pipe, close_ffmpeg_pipe, save_file_obj):
+        self.fake_ffmpeg(ffmpeg_from_pipe, save_file_obj)
+        for (i, pic_id) in enumerate(self.pic_ids):
+            out = io.BytesIO()
+            Image.new('RGB', (64, 48), 'blue').save(out, 'JPEG')
+            self.write_file(f'tagged/{self.printer.id}/{self.print.id}/{pic_id}.jpg', out.getvalue())
+            if i > 0:
+                self.write_file(f'p/{self.printer.id}/{self.print.id}/{pic_id}.json', json.dumps([{'fields': {'current_frame_num': i}}]).encode())
+
+        compile_timelapse(self.print.id)
+
+        self.print.refresh_from_db()
+        self.assertEqual(self.print.tagged_video_url, f'https://example.com/private/{self.print.id}_tagged.mp4')
+        # The pre-rendered tagged pics are what goes into the tagged video
+        first_frame = Image.open(io.BytesIO(self.ffmpegs['ppm'].stdin.getvalue()))
+        self.assertGreater(first_frame.getpixel((32, 24))[2], 200)
+        prediction_json = json.loads(self.saved[f'private/{self.print.id}_p.json'])
+        self.assertEqual(prediction_json, [{}, {'fields': {'current_frame_num': 1}}, {'fields': {'current_frame_num': 2}}])
+
+    @patch('app.tasks.save_tagged_pic', side_effect=OSError('Broken pipe'))
+    def test_ffmpeg_killed_on_error(self, save_tagged_pic, celery_app, ffmpeg_from_pipe, close_ffmpeg_pipe, save_file_obj):
+        procs = []
+
+        def ffmpeg(output_mp4, input_codec, extra_options):
+            procs.append(Mock(stdin=io.BytesIO(), **{'poll.return_value': None}))  # Still running
+            return procs[-1]
+
+        ffmpeg_from_pipe.side_effect = ffmpeg
+        cache.print_prediction_append(self.print.id, self.pic_ids[0], (0, 0, 0.1, 0.1, 0.1, 0.1), [])
+
+        with self.assertRaises(OSError):
+            compile_timelapse(self.print.id)
+
+        self.assertEqual(len(procs), 2)
+        for proc in procs:
+            proc.kill.assert_called_once_with()
+            proc.wait.assert_called_once_with()
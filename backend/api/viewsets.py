@@ -38,7 +38,7 @@ from .serializers import (
     PrintShotFeedbackSerializer, OneTimeVerificationCodeSerializer, SharedResourceSerializer, OctoPrintTunnelSerializer,
     NotificationSettingSerializer, PrinterEventSerializer, GCodeFolderDeSerializer, GCodeFolderSerializer
 )
-from lib.channels import send_status_to_web
+from lib.channels import send_status_to_web, send_printer_changed_to_printer
 from lib import cache, gcode_metadata
 from lib.view_helpers import get_printer_or_404
 from config.celery import celery_app
@@ -150,6 +150,7 @@ class PrinterViewSet(
 
     def partial_update(self, request, pk=None):
         self.get_queryset().filter(pk=pk).update(**request.data)
+        send_printer_changed_to_printer(pk)  # update() doesn't send post_save
         printer = get_printer_or_404(pk, request)
         printer.send_should_watch_status()
 
@@ -14,6 +14,7 @@ from ipware import get_client_ip
 
 from .views import tunnelv2_views
 from lib.tunnelv2 import OctoprintTunnelV2Helper
+from lib import cache
 
 import logging
 
@@ -46,6 +47,16 @@ def octoprint_tunnelv2(get_response):
     return middleware
 
 
+def printer_cache_memoization(get_response):
+    # Printer.status, pic and settings are read from redis once per request
+
+    def middleware(request):
+        with cache.memoization_scope(request.path):
+            return get_response(request)
+
+    return middleware
+
+
 def fix_tunnelv2_apple_cache(get_response):
     # necessary to make caching in ios webviews and safari work
 
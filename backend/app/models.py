@@ -3,9 +3,10 @@ from allauth.account.admin import EmailAddress
 from datetime import datetime, timedelta
 import logging
 import os
+import copy
 import json
 from secrets import token_hex
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, transaction
 from jsonfield import JSONField
 import uuid
 from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
@@ -117,7 +118,13 @@ class User(AbstractUser):
         if self.tunnel_cap() < 0:
             return False
         else:
-            return cache.octoprinttunnel_get_stats(self.id) > self.tunnel_cap() * 1.1 # Cap x 1.1 to give some grace period to users
+            return cache.octoprinttunnel_stats_over(self.id, self.tunnel_cap() * 1.1) # Cap x 1.1 to give some grace period to users
+
+    def tunnel_usage_over_cap_cached(self):
+        if self.tunnel_cap() < 0:
+            return False
+        else:
+            return cache.octoprinttunnel_stats_over_cached(self.id, self.tunnel_cap() * 1.1)
 
 
 # We use a signal as opposed to a form field because users may sign up using social buttons
@@ -178,19 +185,60 @@ class Printer(SafeDeleteModel):
     objects = PrinterManager()
     with_archived = SafeDeleteManager()
 
+    @classmethod
+    def prefetch_cache_snapshot(cls, printers):
+        """
+        Load status, pic and settings of the printers from redis in one round trip, rather than one by one as they are accessed.
+        Meant for the duration of a serialization. Call clear_cache_snapshot when it's done, as the snapshot is not updated.
+        """
+        snapshots = cache.printers_snapshot([printer.id for printer in printers])
+        for printer in printers:
+            printer._cache_snapshot = snapshots[printer.id]
+
+    @classmethod
+    def clear_cache_snapshot(cls, printers):
+        for printer in printers:
+            printer.__dict__.pop('_cache_snapshot', None)
+
+    def cached(self, name, fetch):
+        """
+        What's in redis for the printer, from the prefetched snapshot if there is one.
+        Otherwise it's memoized for the current cache.memoization_scope, until the printer's entries are set in this process.
+        Returns copies, as callers are free to modify what they get.
+        """
+        snapshot = getattr(self, '_cache_snapshot', None)
+        if snapshot is not None:
+            return copy.deepcopy(snapshot[name])
+
+        scope = cache.current_memoization_scope()
+        if scope is None:
+            return fetch()
+
+        memo = self.__dict__.get('_cache_memo')
+        if memo is None or memo[0] is not scope:
+            memo = self.__dict__['_cache_memo'] = (scope, {})
+
+        version = cache.printer_cache_version(self.id)  # Before fetching, so that a concurrent update invalidates what's fetched
+        if name in memo[1] and memo[1][name][0] == version:
+            scope.hits += 1
+        else:
+            memo[1][name] = (version, fetch())
+            scope.misses += 1
+        return copy.deepcopy(memo[1][name][1])
+
     @property
     def status(self):
-        return dict_or_none(cache.printer_status_get(self.id))
+        return dict_or_none(self.cached('status', lambda: cache.printer_status_get(self.id)))
 
     @property
     def pic(self):
-        pic_data = cache.printer_pic_get(self.id)
+        pic_data = self.cached('pic', lambda: cache.printer_pic_get(self.id))
 
         return dict_or_none(pic_data)
 
     @property
     def settings(self):
-        p_settings = cache.printer_settings_get(self.id)
+        p_settings = self.cached('settings', lambda: cache.printer_settings_get(self.id))
 
         for key in ('webcam_flipV', 'webcam_flipH', 'webcam_rotate90'): # `webcam_rotate90` for backward compatibility with old plugins
             p_settings[key] = p_settings.get(key, 'False') == 'True'
@@ -240,7 +288,10 @@ class Printer(SafeDeleteModel):
         return None
 
     def actively_printing(self):
-        printer_cur_state = cache.printer_status_get(self.id, 'state')
+        if getattr(self, '_cache_snapshot', None) is not None or cache.current_memoization_scope() is not None:
+            printer_cur_state = (self.status or {}).get('state')
+        else:
+            printer_cur_state = cache.printer_status_get(self.id, 'state')  # Only the state is read and decoded
 
         return printer_cur_state and printer_cur_state.get('flags', {}).get('printing', False)
 
@@ -264,7 +315,7 @@ class Printer(SafeDeleteModel):
 
         if self.current_print.g_code_file_id != g_code_file_id:
             self.current_print.g_code_file_id = g_code_file_id
-            self.current_print.save()
+            self.current_print.save(update_fields=['g_code_file', 'updated_at'])
 
         # Current print in OctoPrint matches current_print in db. Nothing to update.
         if self.current_print.ext_id == current_print_ts:
@@ -276,7 +327,7 @@ class Printer(SafeDeleteModel):
             LOGGER.warn(
                 f'Apparently skewed print_ts received. ts1: {self.current_print.ext_id} - ts2: {current_print_ts} - print_id: {self.current_print_id} - printer_id: {self.id}')
             self.current_print.ext_id = current_print_ts
-            self.current_print.save()
+            self.current_print.save(update_fields=['ext_id', 'updated_at'])
         else:
             LOGGER.warn(f'Print not properly ended before next start. Stale print_id: {self.current_print_id} - printer_id: {self.id}')
             self.unset_current_print()
@@ -286,13 +337,13 @@ class Printer(SafeDeleteModel):
     def unset_current_print(self):
         print = self.current_print
         self.current_print = None
-        self.save()
+        self.save(update_fields=['current_print', 'updated_at'])
 
         self.printerprediction.reset_for_new_print()
 
         if print.cancelled_at is None:
             print.finished_at = timezone.now()
-            print.save()
+            print.save(update_fields=['finished_at', 'updated_at'])
 
         PrinterEvent.create(print=print, event_type=PrinterEvent.ENDED, task_handler=True)
         self.send_should_watch_status()
@@ -316,7 +367,7 @@ class Printer(SafeDeleteModel):
                 raise Exception('Ended print is re-surrected! printer_id: {} | print_ts: {} | filename: {}'.format(self.id, current_print_ts, filename))
 
         self.current_print = cur_print
-        self.save()
+        self.save(update_fields=['current_print', 'updated_at'])
 
         self.printerprediction.reset_for_new_print()
         PrinterEvent.create(print=cur_print, event_type=PrinterEvent.STARTED, task_handler=True)
@@ -508,7 +559,7 @@ class Print(SafeDeleteModel):
 
     def cancelled(self):
         self.cancelled_at = timezone.now()
-        self.save()
+        self.save(update_fields=['cancelled_at', 'updated_at'])
 
     def alert_acknowledged(self, alert_overwrite):
         if not self.alerted_at:   # Not even alerted. Shouldn't be here. Maybe user error?
@@ -541,6 +592,28 @@ class Print(SafeDeleteModel):
         return self.tagged_video_url or self.uploaded_at
 
 
+# The printer connection (OctoPrintConsumer) holds on to the printer and its current print. Let it know when they are changed elsewhere.
+def send_printer_changed_quietly(printer_id):
+    # Outside of a transaction, on_commit runs it right away, within save(). The save must not fail with it.
+    try:
+        channels.send_printer_changed_to_printer(printer_id)
+    except Exception:
+        LOGGER.exception(f'Failed to notify printer {printer_id} of the change')
+
+
+@receiver(post_save, sender=Printer)
+def notify_printer_changed(sender, instance, **kwargs):
+    printer_id = instance.id
+    transaction.on_commit(lambda: send_printer_changed_quietly(printer_id))
+
+
+@receiver(post_save, sender=Print)
+def notify_print_changed(sender, instance, **kwargs):
+    printer_id = instance.printer_id
+    if printer_id:
+        transaction.on_commit(lambda: send_printer_changed_quietly(printer_id))
+
+
 class PrinterEvent(models.Model):
 
     STARTED = 'STARTED'
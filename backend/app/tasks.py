@@ -10,30 +10,28 @@ import shutil
 import logging
 from django.utils import timezone
 from django.conf import settings
-from django.core import serializers
 from celery import shared_task
 from celery.decorators import periodic_task
 from datetime import timedelta
 import tempfile
-import requests
-from PIL import Image, ImageFile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-import copy
 from django.template.loader import render_to_string, get_template
 from django.core.mail import EmailMessage
-from channels_presence.models import Room
 
 from .models import *
 from .models import Print, PrinterEvent
-from lib.file_storage import list_dir, retrieve_to_file_obj, save_file_obj, delete_dir
-from lib.utils import ml_api_auth_headers, orientation_to_ffmpeg_options, copy_pic, last_pic_of_print
-from lib.prediction import update_prediction_with_detections, is_failing, VISUALIZATION_THRESH
-from lib.image import overlay_detections
+from lib.file_storage import list_dir, retrieve_to_file_obj, save_file_obj, delete_dir, retrieve_many, save_many
+from lib.utils import ml_api_detect_batch, orientation_to_ffmpeg_options, copy_pic, save_pic, last_pic_of_print
+from lib.prediction import update_prediction_with_detections, is_failing, prediction_snapshot, snapshots_to_serializable, VISUALIZATION_THRESH
+from lib.image import save_tagged_pic, split_jpeg_stream
 from lib import cache
 from lib import site
 from notifications.handlers import handler
 from notifications import notification_types
-from api.octoprint_views import IMG_URL_TTL_SECONDS
+from lib.channels import send_status_to_web, prune_ws_connections
+from api.octoprint_views import IMG_URL_TTL_SECONDS, detect_if_needed
 
 LOGGER = logging.getLogger(__name__)
 
@@ -77,6 +75,24 @@ def send_notification_for_print_event(_print, print_event, extra_context=None):
         )
 
 
+@shared_task
+def detect_pic(printer_id, print_id, pic_id, raw_pic_internal_url, raw_pic_external_url):
+    # Asynchronous counterpart of the detection in OctoPrintPicView.post, for settings.PIC_DETECTION_ASYNC
+    printer = Printer.objects.select_related('current_print', 'user').get(id=printer_id)
+    if printer.current_print_id != print_id:   # The print has ended since the pic was uploaded
+        return
+
+    pic = io.BytesIO()
+    retrieve_to_file_obj(f'raw/{printer.id}/{print_id}/{pic_id}.jpg', pic, settings.PICS_CONTAINER, long_term_storage=False)
+    pic.seek(0)
+
+    img_url_updated = detect_if_needed(printer, pic, pic_id, raw_pic_internal_url)
+    if not img_url_updated:
+        cache.printer_pic_set(printer.id, {'img_url': raw_pic_external_url}, ex=IMG_URL_TTL_SECONDS)
+
+    send_status_to_web(printer.id)
+
+
 @shared_task(acks_late=True)
 def compile_timelapse(print_id):
     _print = Print.objects.all_with_deleted().select_related('printer').get(id=print_id)
@@ -90,58 +106,94 @@ def compile_timelapse(print_id):
 
     print_pics = list_dir(f'raw/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
     print_pics.sort()
+    # Detections were performed, and hence tagged pics can be rendered, only on the pics that have a prediction in the series of the print
+    predictions = cache.print_predictions_get(_print.id)
+    pic_id_of = lambda pic_path: os.path.basename(pic_path)[:-len('.jpg')]
+    # Prints that started before the prediction series was in place have their tagged pics already rendered,
+    # and their predictions in a json file next to each of them
+    tagged_path_of = lambda pic_path: pic_path.replace('raw/', 'tagged/', 1)
+    json_path_of = lambda pic_path: pic_path.replace('raw/', 'p/', 1).replace('.jpg', '.json')
+    tagged_files = set()
+    if any(pic_id_of(pic_path) not in predictions for pic_path in print_pics):
+        try:
+            tagged_files = set(list_dir(f'tagged/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False))
+        except FileNotFoundError:  # fs storage raises when the print has no tagged pic at all
+            pass
+    legacy_pics = [pic_path for pic_path in print_pics if pic_id_of(pic_path) not in predictions and tagged_path_of(pic_path) in tagged_files]
+
     if print_pics:
-        local_pics = download_files(print_pics, to_dir)
-        mp4_filename = '{}.mp4'.format(_print.id)
-        output_mp4 = os.path.join(to_dir, mp4_filename)
-        cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p {} {}'.format(local_pics[-1].parent, ffmpeg_extra_options, output_mp4)
-        subprocess.run(cmd.split(), check=True)
+        # Frames are piped from the storage into ffmpeg one at a time. Both videos are encoded at the same time, in a single pass.
+        output_mp4 = os.path.join(to_dir, f'{_print.id}.mp4')
+        ffmpeg = ffmpeg_from_pipe(output_mp4, 'mjpeg', ffmpeg_extra_options)
+        tagged_output_mp4 = os.path.join(to_dir, f'{_print.id}_tagged.mp4')
+        tagged_ffmpeg = None
+
+        try:
+            pics = retrieve_many(print_pics, settings.PICS_CONTAINER, long_term_storage=False)
+            legacy_tagged_pics = retrieve_many([tagged_path_of(pic_path) for pic_path in legacy_pics], settings.PICS_CONTAINER, long_term_storage=False)
+            p_jsons = retrieve_many([json_path_of(pic_path) for pic_path in legacy_pics], settings.PICS_CONTAINER, long_term_storage=False)
+
+            prediction_json = []
+            num_missing_p_json = 0
+            for pic_path, pic in pics:
+                ffmpeg.stdin.write(pic.getbuffer())
+
+                if pic_id_of(pic_path) in predictions:
+                    timestamp, snapshot, detections = predictions[pic_id_of(pic_path)]
+                    prediction_json += snapshots_to_serializable([snapshot], [timestamp])
+                elif tagged_path_of(pic_path) in tagged_files:
+                    _, p_out = next(p_jsons)
+                    try:
+                        p_json = json.loads(p_out.getvalue())
+                    except ValueError as e:    # In case the json could not be retrieved, it will be empty and JSONDecodeError will be thrown
+                        LOGGER.warn(e)
+                        p_json = [{}]
+                        num_missing_p_json += 1
+                        if num_missing_p_json > 5:
+                            shutil.rmtree(to_dir, ignore_errors=True)
+                            clean_up_print_pics(_print)
+                            raise Exception('Too many missing p_json files.')
+                    prediction_json += p_json
+
+                    # The detections are already drawn on it
+                    _, pic = next(legacy_tagged_pics)
+                    detections = []
+                else:
+                    continue
+
+                if not tagged_ffmpeg:
+                    tagged_ffmpeg = ffmpeg_from_pipe(tagged_output_mp4, 'ppm', ffmpeg_extra_options)
+                # Uncompressed, so that the frame is not JPEG encoded only to be decoded by ffmpeg right away
+                pic.seek(0)
+                save_tagged_pic(pic, detections, tagged_ffmpeg.stdin, format='PPM')
+
+            close_ffmpeg_pipe(ffmpeg)
+            if tagged_ffmpeg:
+                close_ffmpeg_pipe(tagged_ffmpeg)
+        finally:
+            # Not to leave ffmpeg processes behind when anything above fails
+            for proc in (ffmpeg, tagged_ffmpeg):
+                if proc and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
 
         with open(output_mp4, 'rb') as mp4_file:
-            _, mp4_file_url = save_file_obj('private/{}'.format(mp4_filename), mp4_file, settings.TIMELAPSE_CONTAINER)
-
+            _, mp4_file_url = save_file_obj(f'private/{_print.id}.mp4', mp4_file, settings.TIMELAPSE_CONTAINER)
         _print.video_url = mp4_file_url
         _print.save(keep_deleted=True)
 
-    # build tagged timelapse
-    print_pics = list_dir(f'tagged/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
-    print_pics.sort()
-    if print_pics:
-        local_pics = download_files(print_pics, to_dir)
-        mp4_filename = '{}_tagged.mp4'.format(_print.id)
-        output_mp4 = os.path.join(to_dir, mp4_filename)
-        cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {} {}'.format(
-            local_pics[0].parent, ffmpeg_extra_options, output_mp4)
-        subprocess.run(cmd.split(), check=True)
-        with open(output_mp4, 'rb') as mp4_file:
-            _, mp4_file_url = save_file_obj('private/{}'.format(mp4_filename), mp4_file, settings.TIMELAPSE_CONTAINER)
-
-        json_files = list_dir(f'p/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
-        local_jsons = download_files(json_files, to_dir)
-        prediction_json = []
-        num_missing_p_json = 0
-        for pic_path in local_pics:
-            try:
-                with open(str(pic_path).replace('tagged/', 'p/').replace('.jpg', '.json'), 'r') as f:
-                    p_json = json.load(f)
-            except (FileNotFoundError, json.decoder.JSONDecodeError) as e:    # In case there is no corresponding json, the file will be empty and JSONDecodeError will be thrown
-                LOGGER.warn(e)
-                p_json = [{}]
-                num_missing_p_json += 1
-                if num_missing_p_json > 5:
-                    shutil.rmtree(to_dir, ignore_errors=True)
-                    clean_up_print_pics(_print)
-                    raise Exception('Too many missing p_json files.')
-
-            prediction_json += p_json
-        prediction_json_io = io.BytesIO()
-        prediction_json_io.write(json.dumps(prediction_json).encode('UTF-8'))
-        prediction_json_io.seek(0)
-        _, json_url = save_file_obj('private/{}_p.json'.format(_print.id), prediction_json_io, settings.TIMELAPSE_CONTAINER)
-
-        _print.tagged_video_url = mp4_file_url
-        _print.prediction_json_url = json_url
-        _print.save(keep_deleted=True)
+        if tagged_ffmpeg:
+            with open(tagged_output_mp4, 'rb') as mp4_file:
+                _, mp4_file_url = save_file_obj(f'private/{_print.id}_tagged.mp4', mp4_file, settings.TIMELAPSE_CONTAINER)
+
+            prediction_json_io = io.BytesIO()
+            prediction_json_io.write(json.dumps(prediction_json).encode('UTF-8'))
+            prediction_json_io.seek(0)
+            _, json_url = save_file_obj('private/{}_p.json'.format(_print.id), prediction_json_io, settings.TIMELAPSE_CONTAINER)
+
+            _print.tagged_video_url = mp4_file_url
+            _print.prediction_json_url = json_url
+            _print.save(keep_deleted=True)
 
     shutil.rmtree(to_dir, ignore_errors=True)
     clean_up_print_pics(_print)
@@ -180,52 +232,74 @@ def detect_timelapse(self, print_id):
     with open(tl_path, 'wb') as file_obj:
         retrieve_to_file_obj(mp4_filepath, file_obj, settings.TIMELAPSE_CONTAINER)
 
-    jpgs_dir = os.path.join(tmp_dir, 'jpgs')
-    shutil.rmtree(jpgs_dir, ignore_errors=True)
-    os.makedirs(jpgs_dir)
-    tagged_jpgs_dir = os.path.join(tmp_dir, 'tagged_jpgs')
-    shutil.rmtree(tagged_jpgs_dir, ignore_errors=True)
-    os.makedirs(tagged_jpgs_dir)
-
     ffprobe_cmd = subprocess.run(
         f'ffprobe -v error -count_frames -select_streams v:0 -show_entries stream=nb_read_frames -of default=nokey=1:noprint_wrappers=1 {tl_path}'.split(), stdout=subprocess.PIPE)
     frame_num = int(ffprobe_cmd.stdout.strip())
     fps = 30*MAX_FRAME_NUM/frame_num if frame_num > MAX_FRAME_NUM else 30
-    subprocess.run(f'ffmpeg -y -i {tl_path} -vf fps={fps} -qscale:v 2 {jpgs_dir}/%5d.jpg'.split())
-
-    predictions = []
-    last_prediction = PrinterPrediction()
-    jpg_filenames = sorted(os.listdir(jpgs_dir))
-    for jpg_path in jpg_filenames:
-        jpg_abs_path = os.path.join(jpgs_dir, jpg_path)
-        with open(jpg_abs_path, 'rb') as pic:
-            pic_path = f'{_print.user.id}/{_print.id}/{jpg_path}'
-            internal_url, _ = save_file_obj(f'uploaded/{pic_path}', pic, settings.PICS_CONTAINER, long_term_storage=False)
-            req = requests.get(settings.ML_API_HOST + '/p/', params={'img': internal_url}, headers=ml_api_auth_headers(), verify=False)
-            req.raise_for_status()
-            detections = req.json()['detections']
-            update_prediction_with_detections(last_prediction, detections)
-            predictions.append(last_prediction)
-
-            if is_failing(last_prediction, 1, escalating_factor=1):
-                _print.alerted_at = timezone.now()
 
-            last_prediction = copy.deepcopy(last_prediction)
-            detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
-            overlay_detections(Image.open(jpg_abs_path), detections_to_visualize).save(os.path.join(tagged_jpgs_dir, jpg_path), "JPEG")
+    # Frames are decoded straight from the output of ffmpeg, and the tagged frames are piped into another ffmpeg.
+    # While one batch of frames is being detected by ML API, the previous one is rendered.
+    extract_ffmpeg = subprocess.Popen(f'ffmpeg -v error -i {tl_path} -vf fps={fps} -qscale:v 2 -f image2pipe -c:v mjpeg -'.split(), stdout=subprocess.PIPE)
+    output_mp4 = os.path.join(tmp_dir, f'{_print.id}_tagged.mp4')
+    tagged_ffmpeg = ffmpeg_from_pipe(output_mp4, 'ppm', '-vf pad=ceil(iw/2)*2:ceil(ih/2)*2')
+
+    def detect(batch_start, jpgs):
+        if settings.ML_API_POST_IMAGE:
+            return ml_api_detect_batch(imgs_bytes=jpgs)
+
+        # ML API downloads the frames by url
+        pic_urls = save_many(
+            [(f'uploaded/{_print.user.id}/{_print.id}/{batch_start + i:05}.jpg', io.BytesIO(jpg)) for i, jpg in enumerate(jpgs)],
+            settings.PICS_CONTAINER,
+            long_term_storage=False)
+        return ml_api_detect_batch(img_urls=[internal_url for internal_url, _ in pic_urls])
+
+    def render(jpg, detections):
+        tagged_frame = io.BytesIO()
+        save_tagged_pic(io.BytesIO(jpg), [d for d in detections if d[1] > VISUALIZATION_THRESH], tagged_frame, format='PPM')
+        return tagged_frame.getbuffer()
+
+    prediction = PrinterPrediction()
+    snapshots = []
+
+    def process(jpgs, detections_future):
+        detections_batch = detections_future.result()
+        for detections in detections_batch:
+            update_prediction_with_detections(prediction, detections)
+            snapshots.append(prediction_snapshot(prediction))
+            if is_failing(prediction, 1, escalating_factor=1):
+                _print.alerted_at = timezone.now()
 
-    predictions_json = serializers.serialize("json", predictions)
+        for tagged_frame in executor.map(render, jpgs, detections_batch):
+            tagged_ffmpeg.stdin.write(tagged_frame)
+
+    last_jpg = None
+    try:
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) + 1) as executor:
+            previous_batch = None
+            for batch_start, jpgs in enumerate_batches(split_jpeg_stream(extract_ffmpeg.stdout), settings.TIMELAPSE_DETECTION_BATCH_SIZE):
+                detections_future = executor.submit(detect, batch_start, jpgs)
+                if previous_batch:
+                    process(*previous_batch)
+                previous_batch = (jpgs, detections_future)
+                last_jpg = jpgs[-1]
+            if previous_batch:
+                process(*previous_batch)
+    except Exception:
+        extract_ffmpeg.kill()
+        tagged_ffmpeg.kill()
+        raise
+
+    extract_ffmpeg.wait()
+    close_ffmpeg_pipe(tagged_ffmpeg)
+
+    predictions_json = json.dumps(snapshots_to_serializable(snapshots))
     _, json_url = save_file_obj(f'private/{_print.id}_p.json', io.BytesIO(str.encode(predictions_json)), settings.TIMELAPSE_CONTAINER)
 
-    mp4_filename = f'{_print.id}_tagged.mp4'
-    output_mp4 = os.path.join(tmp_dir, mp4_filename)
-    subprocess.run(
-        f'ffmpeg -y -r 30 -pattern_type glob -i {tagged_jpgs_dir}/*.jpg -c:v libx264 -pix_fmt yuv420p -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {output_mp4}'.split(), check=True)
     with open(output_mp4, 'rb') as mp4_file:
-        _, mp4_file_url = save_file_obj(f'private/{mp4_filename}', mp4_file, settings.TIMELAPSE_CONTAINER)
+        _, mp4_file_url = save_file_obj(f'private/{_print.id}_tagged.mp4', mp4_file, settings.TIMELAPSE_CONTAINER)
 
-    with open(os.path.join(jpgs_dir, jpg_filenames[-1]), 'rb') as poster_file:
-        _, poster_file_url = save_file_obj(f'private/{_print.id}_poster.jpg', poster_file, settings.TIMELAPSE_CONTAINER)
+    _, poster_file_url = save_file_obj(f'private/{_print.id}_poster.jpg', io.BytesIO(last_jpg), settings.TIMELAPSE_CONTAINER)
 
     _print.tagged_video_url = mp4_file_url
     _print.prediction_json_url = json_url
@@ -239,30 +313,38 @@ def detect_timelapse(self, print_id):
 
 # Websocket connection count house upkeep jobs
 
-@periodic_task(run_every=timedelta(seconds=1200))
+@periodic_task(run_every=timedelta(seconds=60))
 def prune_channel_presence():
-    Room.objects.prune_presences(age=120)
+    prune_ws_connections()
 
 
-@periodic_task(run_every=timedelta(seconds=1200))
-def prune_channel_rooms():
-    Room.objects.prune_rooms()
+# helper functions
 
 
-# helper functions
+def enumerate_batches(items, batch_size):
+    # Yield (index of the first item in the batch, batch)
+    batch = []
+    batch_start = 0
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield (batch_start, batch)
+            batch_start += len(batch)
+            batch = []
+    if batch:
+        yield (batch_start, batch)
 
 
-def download_files(filenames, to_dir, container=settings.PICS_CONTAINER):
-    output_files = []
-    for filename in filenames:
-        output_path = Path(os.path.join(to_dir, filename))
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, 'wb') as file_obj:
-            retrieve_to_file_obj(filename, file_obj, container, long_term_storage=False)
+def ffmpeg_from_pipe(output_mp4, input_codec, extra_options):
+    # Frames are written to stdin of the returned process, as a concatenation of image files
+    cmd = f'ffmpeg -y -f image2pipe -c:v {input_codec} -r 30 -i - -c:v libx264 -pix_fmt yuv420p {extra_options} {output_mp4}'
+    return subprocess.Popen(cmd.split(), stdin=subprocess.PIPE)
 
-        output_files += [output_path]
 
-    return output_files
+def close_ffmpeg_pipe(ffmpeg):
+    ffmpeg.stdin.close()
+    if ffmpeg.wait() != 0:
+        raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg.args)
 
 
 def clean_up_print_pics(_print):
@@ -270,6 +352,7 @@ def clean_up_print_pics(_print):
     delete_dir('raw/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
     delete_dir('tagged/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
     delete_dir('p/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    cache.print_predictions_delete(_print.id)
 
 
 def will_record_timelapse(_print):
@@ -335,10 +418,12 @@ def select_print_shots_for_feedback(_print):
 
         return sorted(selected_timestamps)
 
-    for ts in highest_7_predictions(cache.print_highest_predictions_get(_print.id)):
-        rotated_jpg_url = copy_pic(
-                            f'raw/{_print.printer.id}/{_print.id}/{ts}.jpg',
+    selected_timestamps = highest_7_predictions(cache.print_highest_predictions_get(_print.id))
+    raw_pics = retrieve_many([f'raw/{_print.printer.id}/{_print.id}/{ts}.jpg' for ts in selected_timestamps], settings.PICS_CONTAINER, long_term_storage=False)
+    for ts, (_, raw_pic) in zip(selected_timestamps, raw_pics):
+        rotated_jpg_url = save_pic(
                             f'ff_printshots/{_print.user.id}/{_print.id}/{ts}.jpg',
+                            raw_pic,
                             rotated=True,
                             printer_settings=_print.printer.settings,
                             to_long_term_storage=False
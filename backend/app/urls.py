@@ -11,6 +11,7 @@ urlpatterns = [
     path('accounts/login/', web_views.SocialAccountAwareLoginView.as_view(), name="account_login"),
     path('accounts/signup/', web_views.SocialAccountAwareSignupView.as_view(), name="account_signup"),
     path('media/<path:file_path>', web_views.serve_jpg_file),  # semi hacky solution to serve image files
+    path('tagged_pics/<int:printer_id>/<int:print_id>/<pic_id>.jpg', web_views.serve_tagged_jpg_file),
     path('printers/', web_views.printers, name='printers'),
     re_path('printers/wizard/(?P<route>([^/]+/)*)$', web_views.new_printer),
     path('printers/<int:pk>/', web_views.edit_printer),
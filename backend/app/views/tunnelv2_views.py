@@ -1,12 +1,13 @@
 import time
 import functools
+import itertools
 import re
 import json
 import packaging.version
-from types import MethodType
+from types import MethodType, GeneratorType
 from datetime import datetime, timedelta
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseRedirect, Http404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import condition
 from django.contrib.auth.decorators import login_required
@@ -19,6 +20,7 @@ from lib.view_helpers import get_printer_or_404, get_template_path
 from lib import cache
 from lib import channels
 from lib.tunnelv2 import OctoprintTunnelV2Helper, TunnelAuthenticationError
+from lib.tunnel_dispatcher import dispatcher
 from app.models import OctoPrintTunnel, calc_normalized_p
 
 
@@ -85,10 +87,35 @@ NOT_CONNECTED_HTML = """
 </html>
 """
 
+TOO_MANY_REQUESTS_HTML = """
+<html>
+    <body>
+        <center>
+            <h1>Too Many Requests</h1>
+        </center>
+        <div>
+            <hr>
+            <h3 style="color: red;">
+                Your printer is still working on the previous requests.
+                Please try again in a moment.
+            </h3>
+        </div>
+    </body>
+</html>
+"""
+
 NOT_CONNECTED_STATUS_CODE = 482
 TIMED_OUT_STATUS_CODE = 483
 OVER_FREE_LIMIT_STATUS_CODE = 481
 NOT_AVAILABLE_STATUS_CODE = 484
+TOO_MANY_REQUESTS_STATUS_CODE = 429
+
+class TunnelResponseIncomplete(Exception):
+    """
+    Raised while the response is streamed to the browser, so that the connection is aborted
+    instead of a truncated response going out as if it were complete.
+    """
+
 
 def get_agent_name(octoprinttunnel):
     return octoprinttunnel.printer.agent_name or 'octoprint_obico'
@@ -253,6 +280,67 @@ def save_static_etag(func):
     return inner
 
 
+def serve_static_from_cache(func):
+    """
+    Serve static assets from the cache shared by all tunnels, without going through the printer.
+    Entries are keyed by ETag. An asset is served from the cache only when this tunnel's own printer has already
+    sent that same ETag for the path, so a file another printer sent never replaces the file this printer would send.
+    """
+    @functools.wraps(func)
+    def inner(request, octoprinttunnel, *args, **kwargs):
+        agent = get_agent_name(octoprinttunnel)
+        path = request.get_full_path()
+        if request.method != 'GET' or not should_cache(agent, path):
+            return func(request, octoprinttunnel, *args, **kwargs)
+
+        user = octoprinttunnel.printer.user
+        version = octoprinttunnel.printer.agent_version or '0.0'
+        tunnel_etag = fetch_static_etag(request, octoprinttunnel)
+        if tunnel_etag and not user.tunnel_usage_over_cap():
+            cached = cache.octoprinttunnel_static_get(agent, version, path, tunnel_etag)
+            if cached:
+                (headers, content) = cached
+                cache.octoprinttunnel_update_stats(user.id, len(content))
+                response = HttpResponse(content)
+                for k, v in headers.items():
+                    response[k] = v
+                return response
+
+        response = func(request, octoprinttunnel, *args, **kwargs)
+
+        etag = fix_etag(response.get('Etag', ''))
+        if response.status_code == 200 and etag:
+            headers = {k: v for (k, v) in response.items() if k.lower() != 'set-cookie'}
+            save = functools.partial(cache.octoprinttunnel_static_set, agent, version, path, etag, headers)
+            if response.streaming:
+                response.streaming_content = _save_when_complete(response.streaming_content, save)
+            else:
+                save(response.content)
+
+        return response
+    return inner
+
+
+def _save_when_complete(content, save):
+    """
+    Passes the streamed content through. It's saved only if it has been streamed in full: when the response is
+    truncated, e.g. a chunk never came or its zlib stream didn't end, _tunnel_response_content raises before
+    the end, and when the browser goes away, the iteration is stopped before the end.
+    """
+    chunks, size = [], 0
+    for chunk in content:
+        if chunks is not None:
+            size += len(chunk)
+            if size <= settings.OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_ITEM_BYTES:
+                chunks.append(chunk)
+            else:
+                chunks = None
+        yield chunk
+
+    if chunks is not None:
+        save(b''.join(chunks))
+
+
 def set_response_items(self):
     items = list(self._headers.values())
     if hasattr(self, "tunnel_cookies"):
@@ -262,7 +350,7 @@ def set_response_items(self):
 
 
 def retrieve_klipper_host_info(octoprinttunnel):
-    resp = _tunnel_http_req_and_wait_for_resp(octoprinttunnel,  "/machine/system_info", "get", {}, b'')
+    resp = _tunnel_http_req_and_wait_for_resp(octoprinttunnel,  "/machine/system_info", "get", {}, b'', stream=False)
     network_dict = json.loads(resp.content.decode('utf-8')).get('result', {}).get('system_info', {}).get('network', {})
     ip_addrs = [
         ip['address'] for wlan in network_dict.values()
@@ -276,13 +364,14 @@ def retrieve_klipper_host_info(octoprinttunnel):
         return {}
 
     ip_addr = ip_addrs[0]
-    resp = _tunnel_http_req_and_wait_for_resp(octoprinttunnel,  "/server/config", "get", {}, b'')
+    resp = _tunnel_http_req_and_wait_for_resp(octoprinttunnel,  "/server/config", "get", {}, b'', stream=False)
     server_port = json.loads(resp.content.decode('utf-8')).get('result', {}).get('config', {}).get('server', {}).get('port')
 
     return {'server_ip': ip_addr, 'server_port': server_port, 'linked_name': octoprinttunnel.printer.name}
 
 @save_static_etag
 @condition(etag_func=fetch_static_etag)
+@serve_static_from_cache
 def _octoprint_http_tunnel(request, octoprinttunnel):
     user = octoprinttunnel.printer.user
     version = octoprinttunnel.printer.agent_version or '0.0'
@@ -353,7 +442,7 @@ def _octoprint_http_tunnel(request, octoprinttunnel):
     return _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_headers, request.body, request_is_secure=request.is_secure())
 
 
-def _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_headers, request_body, request_is_secure=False):
+def _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_headers, request_body, request_is_secure=False, stream=True):
     user = octoprinttunnel.printer.user
     ref = f'v2.{octoprinttunnel.id}.{method}.{time.time()}.{path}'
 
@@ -368,11 +457,25 @@ def _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_header
                 'data': request_body
             },
             'as_binary': True,
+            # Lets the plugin know it may send the response in chunks. See _tunnel_response_messages
+            'http.tunnelv2.chunked': True,
         }
     )
-    channels.send_msg_to_printer(*msg)
+    if not dispatcher.begin(octoprinttunnel.printer.id, ref):
+        resp = HttpResponse(
+            TOO_MANY_REQUESTS_HTML,
+            status=TOO_MANY_REQUESTS_STATUS_CODE)
+        resp['Retry-After'] = '1'
+        return resp
 
-    data = cache.octoprinttunnel_http_response_get(ref)
+    try:
+        channels.send_msg_to_printer(*msg)
+    except Exception:
+        dispatcher.end(ref)
+        raise
+
+    messages = _tunnel_response_messages(ref)
+    data = next(messages, None)
     if data is None:
         # request timed out
         return HttpResponse(
@@ -382,10 +485,25 @@ def _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_header
     content_type = data['response']['headers'].get('Content-Type') or None
     status_code = data['response']['status']
 
-    resp = HttpResponse(
-        status=status_code,
-        content_type=content_type,
-    )
+    if 'seq' in data:
+        content = _tunnel_response_content(user, data, messages)
+    else:
+        messages.close()
+        content = _tunnel_response_content(user, data, ())
+
+    rewrite_manifest_link = get_agent_name(octoprinttunnel) == 'moonraker_obico' and path == ('/')
+    if stream and not rewrite_manifest_link:
+        resp = StreamingHttpResponse(
+            content,
+            status=status_code,
+            content_type=content_type,
+        )
+    else:
+        resp = HttpResponse(
+            b''.join(content),
+            status=status_code,
+            content_type=content_type,
+        )
 
     to_ignore = (
         'content-length',  # set by django
@@ -435,19 +553,95 @@ def _tunnel_http_req_and_wait_for_resp(octoprinttunnel, path, method, req_header
         # Unfortunately Django 2 still doesn't have a good way to set headers and hence we have to do this ugly trick
         resp.items = MethodType(set_response_items, resp)
 
-    if data['response'].get('compressed', False):
-        content = zlib.decompress(data['response']['content'])
-    else:
-        content = data['response']['content']
-
-    cache.octoprinttunnel_update_stats(user.id, len(content))
-
-    if get_agent_name(octoprinttunnel) == 'moonraker_obico' and path == ('/') and isinstance(content, bytes):
+    if rewrite_manifest_link:
         # manifest file is fetched without cookie by default, forcing cookie here. https://stackoverflow.com/a/57184506
-        content = content.replace(
+        resp.content = resp.content.replace(
             b'href="/manifest.webmanifest"',
             b'href="/manifest.webmanifest" crossorigin="use-credentials"'
         )
 
-    resp.write(content)
     return resp
+
+
+def _tunnel_response_messages(ref):
+    """
+    Yields the http.tunnelv2 response messages from the plugin, in order. Returns without a message if the response
+    doesn't start in time. Raises TunnelResponseIncomplete if it stops, or skips a chunk, after it has started.
+    The plugin sends either one message with
+    the whole response:
+
+        {'ref': ..., 'response': {'status': ..., 'headers': ..., 'cookies': ..., 'compressed': ..., 'content': ...}}
+
+    or, when the request is marked with 'http.tunnelv2.chunked', a sequence of messages:
+
+        {'ref': ..., 'seq': 0, 'response': {'status': ..., 'headers': ..., 'cookies': ..., 'compressed': ...}, 'content': ..., 'eof': False}
+        {'ref': ..., 'seq': 1, 'content': ..., 'eof': False}
+        ...
+        {'ref': ..., 'seq': n, 'content': ..., 'eof': True}
+
+    When compressed, the contents of the chunks are consecutive pieces of a single zlib stream.
+    """
+    # The time spent waiting for the printer to have room for the request counts toward the gateway timeout too
+    timeout_secs = max(cache.TUNNEL_RSP_TIMEOUT_SECS - dispatcher.queued_secs(ref), 1)
+    expected_seq = 0
+    try:
+        while True:
+            msgs = dispatcher.read(ref, timeout_secs)
+            if not msgs:
+                if expected_seq > 0:
+                    raise TunnelResponseIncomplete(f'Timed out waiting for chunk {expected_seq} of tunnel response {ref}')
+                return
+
+            for data in msgs:
+                if 'seq' not in data:
+                    yield data
+                    return
+
+                if data['seq'] != expected_seq:
+                    raise TunnelResponseIncomplete(f'Got chunk {data["seq"]} instead of {expected_seq} of tunnel response {ref}')
+
+                yield data
+                if data.get('eof', False):
+                    return
+                expected_seq += 1
+
+            timeout_secs = cache.TUNNEL_RSP_CHUNK_TIMEOUT_SECS
+    finally:
+        dispatcher.end(ref)
+
+
+def _tunnel_response_content(user, first_message, more_messages):
+    """
+    Yields the (decompressed) content of the response, as the messages come in.
+    """
+    decompressor = zlib.decompressobj() if first_message['response'].get('compressed', False) else None
+    if 'seq' in first_message:
+        contents = itertools.chain(
+            (first_message.get('content') or b'',),
+            (data.get('content') or b'' for data in more_messages),
+        )
+    else:
+        contents = (first_message['response']['content'] or b'',)
+
+    content_len = 0
+    try:
+        for content in contents:
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            if decompressor:
+                content = decompressor.decompress(content)
+            content_len += len(content)
+            if content:
+                yield content
+
+        if decompressor:
+            content = decompressor.flush()
+            if not decompressor.eof:
+                raise TunnelResponseIncomplete('Compressed content of tunnel response ended before the end of its zlib stream')
+            content_len += len(content)
+            if content:
+                yield content
+    finally:
+        if isinstance(more_messages, GeneratorType):
+            more_messages.close()
+        cache.octoprinttunnel_update_stats(user.id, content_len)
@@ -26,6 +26,7 @@ from app.models import (User, Printer, SharedResource, GCodeFile, NotificationSe
 from app.forms import SocialAccountAwareLoginForm
 from lib import channels
 from lib.file_storage import save_file_obj
+from lib.utils import render_tagged_pic
 from app.tasks import preprocess_timelapse
 from lib import cache
 
@@ -254,6 +255,20 @@ def serve_jpg_file(request, file_path):
         return HttpResponse(fh, content_type=('video/mp4' if file_path.endswith('.mp4') else 'image/jpeg'))
 
 
+def serve_tagged_jpg_file(request, printer_id, print_id, pic_id):
+    url = HmacSignedUrl(request.get_full_path())
+    if not url.is_authorized():
+        return HttpResponseForbidden("You do not have permission to view this media")
+
+    tagged_pic = render_tagged_pic(printer_id, print_id, pic_id)
+    if not tagged_pic:
+        raise Http404("Requested file does not exist")
+
+    response = HttpResponse(tagged_pic, content_type='image/jpeg')
+    response['Cache-Control'] = 'private, max-age=3600'  # Pics never change. Don't render them again for the same viewer
+    return response
+
+
 # Health check that touches DB and redis
 def health_check(request):
     User.objects.all()[:1]
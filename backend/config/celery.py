@@ -17,6 +17,7 @@ celery_app.conf.task_routes = {
     'app_ent.tasks.setup_free_trial': {'queue': 'realtime'},
     'notifications.tasks.send_printer_notifications': {'queue': 'realtime'},
     'notifications.tasks.send_failure_alerts': {'queue': 'realtime'},
+    'app.tasks.detect_pic': {'queue': 'detection'},
 }
 
 # Using a string here means the worker doesn't have to serialize
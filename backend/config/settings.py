@@ -53,7 +53,6 @@ INSTALLED_APPS = [
     'django_extensions',
     'django.contrib.humanize',
     'channels',
-    "channels_presence",
     'whitenoise.runserver_nostatic',
     'hijack',
     'compat',
@@ -96,6 +95,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.middleware.printer_cache_memoization',
     'app.middleware.octoprint_tunnelv2',
     'app.middleware.check_admin_ip_whitelist',
 ]
@@ -328,6 +328,18 @@ if SENTRY_DSN:
 # REDIS client
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379')
 
+# Redis instances that lib/cache spreads its keys over, by key prefix. All of them are REDIS_URL unless set otherwise.
+# Besides redis:// URLs, redis+sentinel://host:port[,host:port...]/service_name[/db] is supported.
+CACHE_REDIS_URLS = {
+    'default': REDIS_URL,
+    'status': os.environ.get('REDIS_STATUS_URL', REDIS_URL),  # printer status, pic, settings, websocket presence
+    'tunnel': os.environ.get('REDIS_TUNNEL_URL', REDIS_URL),  # tunnel responses, stats and static asset cache
+    'discovery': os.environ.get('REDIS_DISCOVERY_URL', REDIS_URL),
+    'throttle': os.environ.get('REDIS_THROTTLE_URL', REDIS_URL),
+}
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 64))  # Per redis instance, client type and process
+REDIS_POOL_TIMEOUT_SECS = int(os.environ.get('REDIS_POOL_TIMEOUT_SECS', 10))
+
 # Django cache
 CACHES = {
     "default": {
@@ -374,6 +386,14 @@ OCTOPRINT_TUNNEL_PORT_RANGE = range(
         int(os.environ.get('OCTOPRINT_TUNNEL_PORT_RANGE').split('-')[0].strip('"\'')),
         int(os.environ.get('OCTOPRINT_TUNNEL_PORT_RANGE').split('-')[1].strip('"\'')),
     ) if os.environ.get('OCTOPRINT_TUNNEL_PORT_RANGE') else None
+# Static assets of OctoPrint/Mainsail/Fluidd are cached and shared between tunnels running the same agent version
+OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_BYTES = int(os.environ.get('OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_BYTES', 256*1024*1024))
+OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_ITEM_BYTES = int(os.environ.get('OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_ITEM_BYTES', 4*1024*1024))
+OCTOPRINT_TUNNEL_MAX_INFLIGHT_PER_PRINTER = int(os.environ.get('OCTOPRINT_TUNNEL_MAX_INFLIGHT_PER_PRINTER', 6))  # Per web process
+# How long a request waits for one of the printer's in-flight requests to finish, before it's turned away
+OCTOPRINT_TUNNEL_INFLIGHT_WAIT_SECS = float(os.environ.get('OCTOPRINT_TUNNEL_INFLIGHT_WAIT_SECS', 10))
+# How many requests may wait that way per printer. More are turned away right away
+OCTOPRINT_TUNNEL_MAX_WAITING_PER_PRINTER = int(os.environ.get('OCTOPRINT_TUNNEL_MAX_WAITING_PER_PRINTER', 4))  # Per web process
 
 # settings export
 SETTINGS_EXPORT = [
@@ -410,12 +430,18 @@ INTERNAL_MEDIA_HOST = os.environ.get('INTERNAL_MEDIA_HOST')
 PICS_CONTAINER = 'tsd-pics'
 TIMELAPSE_CONTAINER = 'tsd-timelapses'
 GCODE_CONTAINER = 'tsd-gcodes'
+FILE_STORAGE_CONCURRENCY = int(os.environ.get('FILE_STORAGE_CONCURRENCY', 8))  # Max number of files to retrieve or save at a time in bulk operations
+FILE_STORAGE_MAX_TRIES = int(os.environ.get('FILE_STORAGE_MAX_TRIES', 3))
 
 BUCKET_PREFIX = os.environ.get('BUCKET_PREFIX')
 ML_API_HOST = os.environ.get('ML_API_HOST')
 ML_API_TOKEN = os.environ.get('ML_API_TOKEN')
+ML_API_POST_IMAGE = get_bool('ML_API_POST_IMAGE', True)  # Post jpg bytes to ML API instead of having it download the image by url. Turn it off for ML API older than the server
+TIMELAPSE_DETECTION_BATCH_SIZE = int(os.environ.get('TIMELAPSE_DETECTION_BATCH_SIZE', 8))  # Frames of an uploaded time-lapse sent to ML API in one request
 
 PIC_POST_LIMIT_PER_MINUTE = int(os.environ.get('PIC_POST_LIMIT_PER_MINUTE', 0)) # 0 means no limits
+# Detect failures in the detection celery queue instead of in the request that uploads the pic. Requires a worker that consumes the "detection" queue.
+PIC_DETECTION_ASYNC = get_bool('PIC_DETECTION_ASYNC', False)
 MIN_DETECTION_INTERVAL = 10 # 10s as the default interval between detections. Recommended not to change as the hyper parameters are tuned based on interval = 10s.
 
 # Hyper parameters for prediction model
@@ -2,31 +2,121 @@ from django.conf import settings
 from django.utils.timezone import now
 from datetime import datetime
 import redis
+import redis.sentinel
 import bson
 import json
-from typing import List, Optional
-
-REDIS = redis.Redis.from_url(
-    settings.REDIS_URL, charset="utf-8", decode_responses=True)
-
-# for binary messages, decoding must be omitted
-BREDIS = redis.Redis.from_url(settings.REDIS_URL, decode_responses=False)
+import hashlib
+import time
+import atexit
+import collections
+import contextlib
+import logging
+import os
+import threading
+from typing import List, Optional, Tuple
 
 # redis key prefix
 TUNNEL_PREFIX = "octoprinttunnel"
 
+
+class BlockingSentinelConnectionPool(redis.sentinel.SentinelConnectionPool, redis.BlockingConnectionPool):
+    """
+    Pool of connections to the master of a Sentinel-monitored instance that, like BlockingConnectionPool,
+    waits up to `timeout` seconds for a connection when all max_connections are in use.
+    """
+
+    def __init__(self, service_name, sentinel_manager, **kwargs):
+        kwargs.setdefault('timeout', settings.REDIS_POOL_TIMEOUT_SECS)
+        super().__init__(service_name, sentinel_manager, **kwargs)
+
+
+def redis_client(url, decode_responses):
+    """
+    A client with its own pool of at most REDIS_MAX_CONNECTIONS connections. When they are all in use,
+    callers wait up to REDIS_POOL_TIMEOUT_SECS for one, instead of failing right away.
+    Besides the usual redis:// URLs, redis+sentinel://host:port[,host:port...]/service_name[/db]
+    connects to the current master of a Sentinel-monitored instance.
+    """
+    if url.startswith('redis+sentinel://'):
+        (hosts, service_name, *db) = url[len('redis+sentinel://'):].split('/')
+        sentinel = redis.sentinel.Sentinel(
+            [(host.split(':')[0], int(host.split(':')[1])) for host in hosts.split(',')],
+        )
+        return sentinel.master_for(
+            service_name,
+            db=int(db[0]) if db and db[0] else 0,
+            decode_responses=decode_responses,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT_SECS,
+            connection_pool_class=BlockingSentinelConnectionPool,
+        )
+
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        decode_responses=decode_responses,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT_SECS,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+# Keys are routed by prefix to the instances in settings.CACHE_REDIS_URLS. Unmatched keys go to 'default'.
+KEY_PREFIX_ROUTES = (
+    (TUNNEL_PREFIX, 'tunnel'),
+    ('printer_discovery:', 'discovery'),
+    ('printer:', 'status'),
+    ('presence:', 'status'),
+    ('thr:', 'throttle'),
+)
+
+# Instances configured with the same URL share the same clients, and hence the same pools.
+# For binary messages, decoding must be omitted, hence 2 clients per URL.
+redis_clients = {
+    (url, decode_responses): redis_client(url, decode_responses=decode_responses)
+    for url in set(settings.CACHE_REDIS_URLS.values())
+    for decode_responses in (True, False)
+}
+
+
+def redis_for(key, binary=False):
+    name = next((name for (prefix, name) in KEY_PREFIX_ROUTES if key.startswith(prefix)), 'default')
+    return redis_clients[(settings.CACHE_REDIS_URLS[name], not binary)]
+
+
+REDIS = redis_for('')
+BREDIS = redis_for('', binary=True)
+
 # max wait time for response from plugin
 TUNNEL_RSP_TIMEOUT_SECS = 55  # Nginx in production has gateway timeout = 60s. Needs to be shorter than that
 
 # drop unconsumed response from redis after this seconds
 TUNNEL_RSP_EXPIRE_SECS = 60
 
+# max wait time for the next chunk of a chunked response from plugin
+TUNNEL_RSP_CHUNK_TIMEOUT_SECS = 30
+
 # sent/received stats expiration
 TUNNEL_STATS_EXPIRE_SECS = 3600 * 24 * 30 * 6
 
+# sent/received stats are accumulated in process and written to redis at most this often
+TUNNEL_STATS_FLUSH_SECS = 5
+
+# how long the decision whether a user's tunnel usage is over the cap is reused
+TUNNEL_CAP_DECISION_TTL_SECS = 10
+
 # etag cache expiration
 TUNNEL_ETAG_EXPIRE_SECS = 3600 * 24 * 3
 
+# redis key prefix of the static asset cache shared by all tunnels
+TUNNEL_STATIC_PREFIX = f"{TUNNEL_PREFIX}.static"
+
+LOGGER = logging.getLogger(__name__)
+
+tunnel_stats_pending = collections.Counter()  # user_id -> bytes not written to redis yet
+tunnel_stats_lock = threading.Lock()
+tunnel_stats_flush_timer = None
+tunnel_cap_decisions = {}  # user_id -> (limit, is_over, decided_at)
+
 
 def disco_device_presence_key(client_ip: str) -> str:
     return f'printer_discovery:{client_ip}:presence'
@@ -53,80 +143,205 @@ def print_key_prefix(print_id):
 def pic_post_throttle_key(printer_id):
     return 'thr:{}:{}'.format(printer_id, datetime.now().minute)
 
-def printer_status_set(printer_id, mapping, ex):
-    if isinstance(mapping, dict):  #TODO: retire this part after 7/1/2023
-        cleaned_mapping = {k: v for k, v in mapping.items() if v is not None}
-        prefix = printer_key_prefix(printer_id) + 'status'
-        REDIS.hmset(prefix, cleaned_mapping)
-        REDIS.expire(prefix, ex)
-    else:
-        prefix = printer_key_prefix(printer_id) + 'status_str'
-        REDIS.setex(prefix, ex, mapping)
+class MemoizationScope:
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0    # redis reads saved
+        self.misses = 0  # redis reads made
+
+
+memoization = threading.local()
+printer_cache_versions = collections.Counter()  # printer_id -> times the printer's entries have been set in this process
+
+
+@contextlib.contextmanager
+def memoization_scope(name):
+    """
+    What's read from redis for a printer (Printer.status, pic and settings) is memoized within the scope, such as a request.
+    Nested scopes are part of the outermost one.
+    """
+    scope = getattr(memoization, 'scope', None)
+    if scope is not None:
+        yield scope
+        return
+
+    scope = memoization.scope = MemoizationScope(name)
+    try:
+        yield scope
+    finally:
+        memoization.scope = None
+        if scope.hits:
+            LOGGER.info(f'{scope.name}: {scope.hits} printer cache reads saved by memoization, {scope.misses} made')
+
+
+def current_memoization_scope():
+    return getattr(memoization, 'scope', None)
+
+
+def printer_cache_version(printer_id):
+    return printer_cache_versions[int(printer_id)]
+
+
+def invalidate_printer_memo(printer_id):
+    printer_cache_versions[int(printer_id)] += 1
+
+
+# Fields of the printer status that are read on their own often enough to be stored separately. See printer_status_doc_set
+STATUS_HOT_FIELDS = ('state', 'progress', 'temperatures', 'currentZ')
+
+
+def printer_status_set(printer_id, mapping, ex):  #TODO: retire this after 7/1/2023. Replaced by printer_status_doc_set
+    cleaned_mapping = {k: v for k, v in mapping.items() if v is not None}
+    prefix = printer_key_prefix(printer_id) + 'status'
+    redis_for(prefix).hmset(prefix, cleaned_mapping)
+    redis_for(prefix).expire(prefix, ex)
+    invalidate_printer_memo(printer_id)  # After the update, so that it can't be fetched and memoized as the new version
+
+
+def printer_status_doc_set(printer_id, status, ex):
+    """
+    The hot fields of the status (STATUS_HOT_FIELDS) are stored as separate fields of a hash, so that they can be read
+    without decoding the whole status. The rest is stored BSON-encoded in the 'doc' field.
+    """
+    mapping = {'doc': bson.dumps({k: v for k, v in status.items() if k not in STATUS_HOT_FIELDS})}
+    for k in STATUS_HOT_FIELDS:
+        if k in status:
+            mapping[k] = json.dumps(status[k])
+
+    key = printer_key_prefix(printer_id) + 'status_doc'
+    with redis_for(key, binary=True).pipeline() as pipe:
+        pipe.delete(key)  # Hot fields no longer in the status
+        pipe.hmset(key, mapping)
+        pipe.expire(key, ex)
+        pipe.execute()
+    invalidate_printer_memo(printer_id)
+
+
+def status_from_doc_fields(fields):
+    status = bson.loads(fields[b'doc'])
+    for k, v in fields.items():
+        if k != b'doc':
+            status[k.decode()] = json.loads(v)
+    return status
 
 
 def printer_status_get(printer_id, key=None):
-    prefix = printer_key_prefix(printer_id) + 'status_str'
-    status = REDIS.get(prefix)
-    if status:
-        results = json.loads(status)
-        if key:
-            return results.get(key)
+    # Besides status_doc, statuses in the formats of older plugins or of older versions of this function,
+    # are in status_str or in the status hash.
+    prefix = printer_key_prefix(printer_id)
+    with redis_for(prefix, binary=True).pipeline(transaction=False) as pipe:
+        if key is None:
+            pipe.hgetall(prefix + 'status_doc')
+        elif key in STATUS_HOT_FIELDS:
+            pipe.hmget(prefix + 'status_doc', 'doc', key)  # Not decoding 'doc'. Only to tell if there's a status at all
+        else:
+            pipe.hget(prefix + 'status_doc', 'doc')
+        pipe.get(prefix + 'status_str')
+        if key is None:
+            pipe.hgetall(prefix + 'status')
         else:
-            return results
+            pipe.hget(prefix + 'status', key)
+        (doc, status_str, status_data) = pipe.execute()
 
-    prefix = printer_key_prefix(printer_id) + 'status'
-    if key:
-        v = REDIS.hget(prefix, key)
-        if not v:
-            return None
-        return json.loads(v)
-    else:
-        status_data = REDIS.hgetall(prefix)
-        for k, v in status_data.items():
-            status_data[k] = json.loads(v)
-        return status_data
+    if key is None:
+        if doc:
+            return status_from_doc_fields(doc)
+        if status_str:
+            return json.loads(status_str)
+        return {k.decode(): json.loads(v) for k, v in status_data.items()}
+
+    if key in STATUS_HOT_FIELDS:
+        (doc, v) = doc
+        if doc:
+            return json.loads(v) if v else None
+    elif doc:
+        return bson.loads(doc).get(key)
+
+    if status_str:
+        return json.loads(status_str).get(key)
+    return json.loads(status_data) if status_data else None
 
 
 def printer_status_delete(printer_id):
-    REDIS.delete(printer_key_prefix(printer_id) + 'status_str')
-    REDIS.delete(printer_key_prefix(printer_id) + 'status')
+    prefix = printer_key_prefix(printer_id)
+    redis_for(prefix).delete(prefix + 'status_doc', prefix + 'status_str', prefix + 'status')
+    invalidate_printer_memo(printer_id)
 
 
 def printer_pic_set(printer_id, mapping, ex=None):
     cleaned_mapping = {k: v for k, v in mapping.items() if v is not None}
     prefix = printer_key_prefix(printer_id) + 'pic'
-    REDIS.hmset(prefix, cleaned_mapping)
+    redis_for(prefix).hmset(prefix, cleaned_mapping)
     if ex:
-        REDIS.expire(prefix, ex)
+        redis_for(prefix).expire(prefix, ex)
+    invalidate_printer_memo(printer_id)
 
 
 def printer_pic_get(printer_id, key=None):
     prefix = printer_key_prefix(printer_id) + 'pic'
     if key:
-        return REDIS.hget(prefix, key)
+        return redis_for(prefix).hget(prefix, key)
     else:
-        return REDIS.hgetall(prefix)
+        return redis_for(prefix).hgetall(prefix)
 
 
 def printer_settings_set(printer_id, mapping, ex=None):
     cleaned_mapping = {k: v for k, v in mapping.items() if v is not None}
     prefix = printer_key_prefix(printer_id) + 'settings'
-    REDIS.hmset(prefix, cleaned_mapping)
+    redis_for(prefix).hmset(prefix, cleaned_mapping)
     if ex:
-        REDIS.expire(prefix, ex)
+        redis_for(prefix).expire(prefix, ex)
+    invalidate_printer_memo(printer_id)
 
 
 def printer_settings_get(printer_id, key=None):
     prefix = printer_key_prefix(printer_id) + 'settings'
     if key:
-        return REDIS.hget(prefix, key)
+        return redis_for(prefix).hget(prefix, key)
     else:
-        return REDIS.hgetall(prefix)
+        return redis_for(prefix).hgetall(prefix)
+
+
+def printers_snapshot(printer_ids):
+    """
+    Status, pic and settings of many printers in one round trip.
+    Returns {printer_id: {'status': ..., 'pic': ..., 'settings': ...}}, where the values are what
+    printer_status_get, printer_pic_get and printer_settings_get return.
+    """
+    printer_ids = list(printer_ids)
+    if not printer_ids:
+        return {}
+
+    with redis_for(printer_key_prefix(printer_ids[0]), binary=True).pipeline(transaction=False) as pipe:
+        for printer_id in printer_ids:
+            prefix = printer_key_prefix(printer_id)
+            pipe.hgetall(prefix + 'status_doc')
+            pipe.get(prefix + 'status_str')
+            pipe.hgetall(prefix + 'status')
+            pipe.hgetall(prefix + 'pic')
+            pipe.hgetall(prefix + 'settings')
+        results = pipe.execute()
+
+    def decoded(fields):
+        return {k.decode(): v.decode() for k, v in fields.items()}
+
+    snapshots = {}
+    for i, printer_id in enumerate(printer_ids):
+        (status_doc, status_str, status_data, pic_data, settings_data) = results[i*5:i*5+5]
+        if status_doc:
+            status = status_from_doc_fields(status_doc)
+        elif status_str:
+            status = json.loads(status_str)
+        else:
+            status = {k: json.loads(v) for k, v in decoded(status_data).items()}
+        snapshots[printer_id] = {'status': status, 'pic': decoded(pic_data), 'settings': decoded(settings_data)}
+    return snapshots
 
 
 def print_num_predictions_incr(print_id):
     key = f'{print_key_prefix(print_id)}:pred'
-    with REDIS.pipeline() as pipe:
+    with redis_for(key).pipeline() as pipe:
         pipe.incr(key)
         # Assuming it'll be processed in 30 days.
         pipe.expire(key, 60*60*24*30)
@@ -135,18 +350,18 @@ def print_num_predictions_incr(print_id):
 
 def print_num_predictions_get(print_id):
     key = f'{print_key_prefix(print_id)}:pred'
-    return int(REDIS.get(key) or 0)
+    return int(redis_for(key).get(key) or 0)
 
 
 def print_num_predictions_delete(print_id):
     key = f'{print_key_prefix(print_id)}:pred'
-    return REDIS.delete(key)
+    return redis_for(key).delete(key)
 
 
 def print_high_prediction_add(print_id, prediction, timestamp, maxsize=180):
 
     key = f'{print_key_prefix(print_id)}:hp'
-    with REDIS.pipeline() as pipe:
+    with redis_for(key).pipeline() as pipe:
         pipe.zadd(key, {timestamp: prediction})
         pipe.zremrangebyrank(key, 0, (-1*maxsize+1))
         # Assuming it'll be processed in 3 days.
@@ -156,37 +371,128 @@ def print_high_prediction_add(print_id, prediction, timestamp, maxsize=180):
 
 def print_highest_predictions_get(print_id):
     key = f'{print_key_prefix(print_id)}:hp'
-    return REDIS.zrevrange(key, 0, -1, withscores=True)
+    return redis_for(key).zrevrange(key, 0, -1, withscores=True)
 
 
 def print_progress_set(print_id, progress_percent):
     key = f'{print_key_prefix(print_id)}:pct'
-    REDIS.set(key, str(progress_percent), ex=60*60*24*2)
+    redis_for(key).set(key, str(progress_percent), ex=60*60*24*2)
 
 
 def print_progress_get(print_id):
     key = f'{print_key_prefix(print_id)}:pct'
-    return int(REDIS.get(key) or 0)
+    return int(redis_for(key).get(key) or 0)
+
+
+# Assuming the print will be processed in 30 days, same as the number of predictions.
+PRINT_PREDICTIONS_EXPIRE_SECS = 60*60*24*30
+
+
+def print_prediction_append(print_id, pic_id, snapshot, detections):
+    '''
+    Append the prediction of a pic to the time series of the print. The id of the stream entry is the time it's appended.
+    snapshot: the tuple of lib.prediction.PREDICTION_SNAPSHOT_FIELDS
+    detections: the detections to be rendered on the tagged pic
+    '''
+    key = f'{print_key_prefix(print_id)}:preds'
+    dets_key = f'{print_key_prefix(print_id)}:dets'
+    with redis_for(key).pipeline() as pipe:
+        pipe.xadd(key, {'pic': pic_id, 's': json.dumps(snapshot)})
+        pipe.hset(dets_key, pic_id, json.dumps(detections))
+        pipe.expire(key, PRINT_PREDICTIONS_EXPIRE_SECS)
+        pipe.expire(dets_key, PRINT_PREDICTIONS_EXPIRE_SECS)
+        pipe.execute()
+
+
+def print_predictions_get(print_id):
+    '''
+    Return: {pic_id: (timestamp, snapshot, detections)} of the predictions appended to the print, in the order they were appended.
+    '''
+    key = f'{print_key_prefix(print_id)}:preds'
+    dets_key = f'{print_key_prefix(print_id)}:dets'
+    with redis_for(key).pipeline() as pipe:
+        pipe.xrange(key)
+        pipe.hgetall(dets_key)
+        entries, dets = pipe.execute()
+
+    predictions = {}
+    for entry_id, fields in entries:
+        pic_id = fields['pic']
+        timestamp = int(entry_id.split('-')[0]) / 1000.0
+        predictions[pic_id] = (timestamp, tuple(json.loads(fields['s'])), json.loads(dets.get(pic_id) or '[]'))
+    return predictions
+
+
+def print_prediction_detections_get(print_id, pic_id):
+    '''
+    Return: the detections appended along with the prediction of the pic, or None if the pic has no prediction.
+    '''
+    key = f'{print_key_prefix(print_id)}:dets'
+    dets = redis_for(key).hget(key, pic_id)
+    return json.loads(dets) if dets is not None else None
+
+
+def print_predictions_delete(print_id):
+    key = f'{print_key_prefix(print_id)}:preds'
+    return redis_for(key).delete(key, f'{print_key_prefix(print_id)}:dets')
+
+
+# Long enough for all the viewers of the latest tagged pic of a printer to be served the same rendering.
+TAGGED_PIC_EXPIRE_SECS = 60*10
+
+
+def print_tagged_pic_get(print_id, pic_id):
+    key = f'{print_key_prefix(print_id)}:tagged:{pic_id}'
+    return redis_for(key, binary=True).get(key)
+
+
+def print_tagged_pic_set(print_id, pic_id, jpg_bytes):
+    key = f'{print_key_prefix(print_id)}:tagged:{pic_id}'
+    redis_for(key, binary=True).set(key, jpg_bytes, ex=TAGGED_PIC_EXPIRE_SECS)
+
+
+def octoprinttunnel_http_response_key(ref):
+    return f"{TUNNEL_PREFIX}.{ref}"
 
 
 def octoprinttunnel_http_response_set(ref, data,
                                       expire_secs=TUNNEL_RSP_EXPIRE_SECS):
-    key = f"{TUNNEL_PREFIX}.{ref}"
-    with BREDIS.pipeline() as pipe:
-        pipe.lpush(key, bson.dumps(data))
+    # Responses are queued in a stream, as chunked responses come in as a sequence of messages
+    key = octoprinttunnel_http_response_key(ref)
+    with redis_for(key, binary=True).pipeline() as pipe:
+        pipe.xadd(key, {'m': bson.dumps(data)})
         pipe.expire(key, expire_secs)
         pipe.execute()
 
 
-def octoprinttunnel_http_response_get(ref, timeout_secs=TUNNEL_RSP_TIMEOUT_SECS):
-    # no way to delete key in after blpop in a pipeline as
-    # blpop does not block in that case..
-    key = f"{TUNNEL_PREFIX}.{ref}"
-    ret = BREDIS.blpop(key, timeout=timeout_secs)
-    if ret is not None and ret[1] is not None:
-        BREDIS.delete(key)
-        return bson.loads(ret[1])
-    return None
+def octoprinttunnel_http_responses_read(last_ids, timeout_secs=TUNNEL_RSP_TIMEOUT_SECS, count=16):
+    """
+    Returns {ref: [(msg_id, data), ...]} of the messages queued after last_ids ({ref: last_id}),
+    waiting up to timeout_secs for any to come.
+    Messages are removed from redis once they are read, so that a large response is never held there in full.
+    """
+    refs = {octoprinttunnel_http_response_key(ref): ref for ref in last_ids}
+    ret = redis_for(TUNNEL_PREFIX, binary=True).xread(
+        {octoprinttunnel_http_response_key(ref): last_id for (ref, last_id) in last_ids.items()},
+        count=count,
+        block=int(timeout_secs * 1000),
+    )
+    if not ret:
+        return {}
+
+    with redis_for(TUNNEL_PREFIX, binary=True).pipeline() as pipe:
+        for (key, msgs) in ret:
+            pipe.xdel(key, *[msg_id for (msg_id, _) in msgs])
+        pipe.execute()
+
+    return {
+        refs[key.decode()]: [(msg_id, bson.loads(fields[b'm'])) for (msg_id, fields) in msgs]
+        for (key, msgs) in ret
+    }
+
+
+def octoprinttunnel_http_response_delete(ref):
+    redis_for(TUNNEL_PREFIX, binary=True).delete(octoprinttunnel_http_response_key(ref))
 
 
 def octoprinttunnel_stats_key(date):
@@ -195,16 +501,87 @@ def octoprinttunnel_stats_key(date):
 
 
 def octoprinttunnel_update_stats(user_id, delta):
+    global tunnel_stats_flush_timer
+
+    with tunnel_stats_lock:
+        tunnel_stats_pending[str(user_id)] += int(delta)
+        if tunnel_stats_flush_timer is not None:
+            return
+
+        tunnel_stats_flush_timer = threading.Timer(TUNNEL_STATS_FLUSH_SECS, octoprinttunnel_flush_stats)
+        tunnel_stats_flush_timer.daemon = True
+        tunnel_stats_flush_timer.start()
+
+
+def octoprinttunnel_flush_stats():
+    global tunnel_stats_flush_timer
+
+    with tunnel_stats_lock:
+        deltas = dict(tunnel_stats_pending)
+        tunnel_stats_pending.clear()
+        tunnel_stats_flush_timer = None
+
+    if not deltas:
+        return
+
     key = octoprinttunnel_stats_key(now())
-    with REDIS.pipeline() as pipe:
-        pipe.hincrby(key, str(user_id), int(delta))
-        pipe.expire(key, TUNNEL_STATS_EXPIRE_SECS)
-        pipe.execute()
+    try:
+        with redis_for(key).pipeline() as pipe:
+            for user_id, delta in deltas.items():
+                pipe.hincrby(key, user_id, delta)
+            pipe.expire(key, TUNNEL_STATS_EXPIRE_SECS)
+            pipe.execute()
+    except Exception:
+        LOGGER.exception('Failed to flush tunnel stats. Will retry with the next flush')
+        with tunnel_stats_lock:
+            tunnel_stats_pending.update(deltas)
+
+
+atexit.register(octoprinttunnel_flush_stats)
+
+
+def octoprinttunnel_reset_stats_in_child():
+    # A forked process inherits the timer, but not its thread, and what's pending is the parent's to flush.
+    # The lock may have been held by another thread of the parent, which doesn't exist in the child.
+    global tunnel_stats_flush_timer, tunnel_stats_lock
+    tunnel_stats_lock = threading.Lock()
+    tunnel_stats_pending.clear()
+    tunnel_stats_flush_timer = None
+
+
+os.register_at_fork(after_in_child=octoprinttunnel_reset_stats_in_child)
 
 
 def octoprinttunnel_get_stats(user_id):
     key = octoprinttunnel_stats_key(now())
-    return int(REDIS.hget(key, str(user_id)) or '0')
+    with tunnel_stats_lock:
+        pending = tunnel_stats_pending[str(user_id)]
+    return int(redis_for(key).hget(key, str(user_id)) or '0') + pending
+
+
+def octoprinttunnel_stats_over(user_id, limit):
+    """
+    Whether the month-to-date usage is over limit. The answer is reused for TUNNEL_CAP_DECISION_TTL_SECS.
+    """
+    is_over = octoprinttunnel_stats_over_cached(user_id, limit)
+    if is_over is not None:
+        return is_over
+
+    is_over = octoprinttunnel_get_stats(user_id) > limit
+    if len(tunnel_cap_decisions) > 10000:
+        tunnel_cap_decisions.clear()
+    tunnel_cap_decisions[user_id] = (limit, is_over, time.time())
+    return is_over
+
+
+def octoprinttunnel_stats_over_cached(user_id, limit):
+    """
+    The answer octoprinttunnel_stats_over would reuse, or None if there isn't a fresh one. Never touches redis.
+    """
+    decision = tunnel_cap_decisions.get(user_id)
+    if decision and decision[0] == limit and time.time() - decision[2] < TUNNEL_CAP_DECISION_TTL_SECS:
+        return decision[1]
+    return None
 
 
 def octoprinttunnel_etag_key(printer_id: int, path: str) -> str:
@@ -213,19 +590,82 @@ def octoprinttunnel_etag_key(printer_id: int, path: str) -> str:
 
 def octoprinttunnel_get_etag(printer_id: int, path: str) -> Optional[str]:
     key = octoprinttunnel_etag_key(printer_id, path)
-    return REDIS.get(key) or None
+    return redis_for(key).get(key) or None
 
 
 def octoprinttunnel_update_etag(printer_id: int, path: str, etag: str) -> None:
     key = octoprinttunnel_etag_key(printer_id, path)
-    REDIS.setex(key, TUNNEL_ETAG_EXPIRE_SECS, etag)
+    redis_for(key).setex(key, TUNNEL_ETAG_EXPIRE_SECS, etag)
+
+
+def octoprinttunnel_static_index_key(agent: str, version: str, path: str, etag: str) -> str:
+    digest = hashlib.sha1('\n'.join((agent, version, path, etag)).encode('utf-8')).hexdigest()
+    return f'{TUNNEL_STATIC_PREFIX}.idx.{digest}'
+
+
+def octoprinttunnel_static_get(agent: str, version: str, path: str, etag: str) -> Optional[Tuple[dict, bytes]]:
+    """
+    Returns (headers, content) of the asset cached for the path and ETag by any tunnel of the agent version.
+    """
+    entry = redis_for(TUNNEL_STATIC_PREFIX, binary=True).hgetall(octoprinttunnel_static_index_key(agent, version, path, etag))
+    if not entry:
+        return None
+
+    sha = entry[b'sha'].decode()
+    with redis_for(TUNNEL_STATIC_PREFIX, binary=True).pipeline() as pipe:
+        pipe.get(f'{TUNNEL_STATIC_PREFIX}.blob.{sha}')
+        pipe.zadd(f'{TUNNEL_STATIC_PREFIX}.lru', {sha: time.time()}, xx=True)
+        (content, _) = pipe.execute()
+
+    if content is None:  # evicted
+        return None
+    return (json.loads(entry[b'headers']), content)
+
+
+def octoprinttunnel_static_set(agent: str, version: str, path: str, etag: str, headers: dict, content: bytes) -> None:
+    """
+    Contents are stored by their hash, so that identical files under different versions or paths are stored only once.
+    They are evicted in LRU order when their total size goes over OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_BYTES.
+    """
+    if len(content) > settings.OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_ITEM_BYTES:
+        return
+
+    sha = hashlib.sha256(content).hexdigest()
+    index_key = octoprinttunnel_static_index_key(agent, version, path, etag)
+    with redis_for(TUNNEL_STATIC_PREFIX, binary=True).pipeline() as pipe:
+        pipe.hmset(index_key, {'sha': sha, 'headers': json.dumps(headers)})
+        pipe.expire(index_key, TUNNEL_ETAG_EXPIRE_SECS)
+        pipe.set(f'{TUNNEL_STATIC_PREFIX}.blob.{sha}', content, nx=True)
+        pipe.zadd(f'{TUNNEL_STATIC_PREFIX}.lru', {sha: time.time()})
+        (_, _, is_new_blob, _) = pipe.execute()
+
+    if not is_new_blob:
+        return
+
+    with redis_for(TUNNEL_STATIC_PREFIX, binary=True).pipeline() as pipe:
+        pipe.hset(f'{TUNNEL_STATIC_PREFIX}.sizes', sha, len(content))
+        pipe.incrby(f'{TUNNEL_STATIC_PREFIX}.total', len(content))
+        (_, total) = pipe.execute()
+
+    while total > settings.OCTOPRINT_TUNNEL_STATIC_CACHE_MAX_BYTES:
+        popped = redis_for(TUNNEL_STATIC_PREFIX, binary=True).zpopmin(f'{TUNNEL_STATIC_PREFIX}.lru')
+        if not popped:
+            break
+
+        evicted_sha = popped[0][0].decode()
+        size = int(redis_for(TUNNEL_STATIC_PREFIX, binary=True).hget(f'{TUNNEL_STATIC_PREFIX}.sizes', evicted_sha) or 0)
+        with redis_for(TUNNEL_STATIC_PREFIX, binary=True).pipeline() as pipe:
+            pipe.delete(f'{TUNNEL_STATIC_PREFIX}.blob.{evicted_sha}')
+            pipe.hdel(f'{TUNNEL_STATIC_PREFIX}.sizes', evicted_sha)
+            pipe.decrby(f'{TUNNEL_STATIC_PREFIX}.total', size)
+            (_, _, total) = pipe.execute()
 
 
 def print_status_mobile_push_set(print_id, mobile_platform, ex):
-    REDIS.set(f'{print_key_prefix(print_id)}:psmp:{mobile_platform}', 'pushed', ex=ex)
+    redis_for(print_key_prefix(print_id)).set(f'{print_key_prefix(print_id)}:psmp:{mobile_platform}', 'pushed', ex=ex)
 
 def print_status_mobile_push_get(print_id, mobile_platform):
-    return REDIS.get(f'{print_key_prefix(print_id)}:psmp:{mobile_platform}')
+    return redis_for(print_key_prefix(print_id)).get(f'{print_key_prefix(print_id)}:psmp:{mobile_platform}')
 
 
 def disco_update_raw_device_info(
@@ -237,7 +677,7 @@ def disco_update_raw_device_info(
 ) -> None:
     tordset_key = disco_device_presence_key(client_ip)
     device_info_key = disco_device_info_key(client_ip, device_id)
-    with REDIS.pipeline() as conn:
+    with redis_for(tordset_key).pipeline() as conn:
         conn.zadd(tordset_key, {device_id: cur_time})
         conn.expire(tordset_key, expiration_secs)
         conn.setex(device_info_key, expiration_secs, raw_deviceinfo)
@@ -250,14 +690,14 @@ def disco_get_active_raw_device_infos(
     expiration_secs: int
 ) -> List[str]:
     tordset_key = disco_device_presence_key(client_ip)
-    with REDIS.pipeline() as conn:
+    with redis_for(tordset_key).pipeline() as conn:
         conn.zremrangebyscore(
             tordset_key, min="-inf", max=cur_time - expiration_secs)
         conn.zrangebyscore(
             tordset_key, min=cur_time - expiration_secs, max='+inf')
         device_ids = conn.execute()[1]
 
-    with REDIS.pipeline() as conn:
+    with redis_for(tordset_key).pipeline() as conn:
         # TODO / DEBUG: REDIS.mget somehow freezes
         # so for now I'm doing it the verbose way
         for device_id in device_ids:
@@ -279,7 +719,7 @@ def disco_push_raw_device_message(
     expiration_secs: int
 ) -> None:
     tordset_key = disco_to_device_message_queue_key(client_ip, device_id)
-    with REDIS.pipeline() as conn:
+    with redis_for(tordset_key).pipeline() as conn:
         conn.zremrangebyscore(
             tordset_key, min="-inf", max=cur_time - expiration_secs)
         conn.zadd(tordset_key, {raw_message: cur_time})
@@ -295,7 +735,7 @@ def disco_pop_raw_device_messages(
     message_count: int
 ) -> List[str]:
     tordset_key = disco_to_device_message_queue_key(client_ip, device_id)
-    with REDIS.pipeline() as conn:
+    with redis_for(tordset_key).pipeline() as conn:
         conn.zremrangebyscore(
             tordset_key, min='-inf', max=cur_time - expiration_secs)
         conn.zpopmin(tordset_key, message_count)
@@ -303,9 +743,67 @@ def disco_pop_raw_device_messages(
 
 def pic_post_over_limit(printer_id, limit_per_minute):
     key = pic_post_throttle_key(printer_id)
-    with REDIS.pipeline() as pipe:
+    with redis_for(key).pipeline() as pipe:
         pipe.incr(key)
         pipe.expire(key, 60)
         (cnt, _) = pipe.execute()
 
-    return cnt > limit_per_minute
\ No newline at end of file
+    return cnt > limit_per_minute
+
+
+# Websocket connections of a channel group (e.g., all web clients of a printer).
+# A sorted set of channel names per group, scored by the time of the last heartbeat.
+
+PRESENCE_MAX_AGE_SECS = 120
+PRESENCE_GROUPS_KEY = 'presence:groups'
+
+
+def presence_key(group_name):
+    return f'presence:{group_name}'
+
+
+def presence_add(group_name, channel_name, cur_time) -> bool:
+    key = presence_key(group_name)
+    with redis_for(key).pipeline() as pipe:
+        pipe.zadd(key, {channel_name: cur_time})
+        pipe.expire(key, PRESENCE_MAX_AGE_SECS * 2)  # In case all the connections are gone without saying goodbye
+        pipe.sadd(PRESENCE_GROUPS_KEY, group_name)
+        (added, _, _) = pipe.execute()
+    return added > 0
+
+
+def presence_remove(group_name, channel_name) -> bool:
+    return redis_for(PRESENCE_GROUPS_KEY).zrem(presence_key(group_name), channel_name) > 0
+
+
+def presence_touch(group_name, channel_name, cur_time):
+    key = presence_key(group_name)
+    with redis_for(key).pipeline() as pipe:
+        pipe.zadd(key, {channel_name: cur_time}, xx=True)
+        pipe.expire(key, PRESENCE_MAX_AGE_SECS * 2)
+        pipe.execute()
+
+
+def presence_count(group_name) -> int:
+    return redis_for(PRESENCE_GROUPS_KEY).zcard(presence_key(group_name))
+
+
+def presence_prune(cur_time) -> List[str]:
+    """Removes the connections that have missed heartbeats. Returns the groups that have lost connections."""
+    r = redis_for(PRESENCE_GROUPS_KEY)
+    group_names = list(r.smembers(PRESENCE_GROUPS_KEY))
+    if not group_names:
+        return []
+
+    # All the groups in one round trip, so that the cost doesn't grow with the number of printers
+    with r.pipeline(transaction=False) as pipe:
+        for group_name in group_names:
+            pipe.zremrangebyscore(presence_key(group_name), min='-inf', max=cur_time - PRESENCE_MAX_AGE_SECS)
+            pipe.zcard(presence_key(group_name))
+        results = pipe.execute()
+
+    changed_groups = [group_name for (group_name, removed) in zip(group_names, results[0::2]) if removed > 0]
+    empty_groups = [group_name for (group_name, remaining) in zip(group_names, results[1::2]) if remaining == 0]
+    if empty_groups:
+        r.srem(PRESENCE_GROUPS_KEY, *empty_groups)
+    return changed_groups
@@ -1,12 +1,17 @@
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 import json
-from channels_presence.models import Room
-from django.dispatch import receiver
-from channels_presence.signals import presence_changed
+import logging
+import threading
+import time
+from django import db
 
 from . import cache
 
+LOGGER = logging.getLogger(__name__)
+
+STATUS_COALESCE_SECS = 0.5
+
 def octo_group_name(printer_id):
     return 'p_octo.{}'.format(printer_id)
 
@@ -21,36 +26,116 @@ def octoprinttunnel_group_name(printer_id):
     return 'octoprinttunnel.{}'.format(printer_id)
 
 
-def send_msg_to_printer(printer_id, msg_dict):
+# The *_async variants are for the consumers, which run in the event loop where async_to_sync can't be used.
+
+async def send_msg_to_printer_async(printer_id, msg_dict):
     msg_dict.update({
         'type': 'printer.message',  # mapped to -> printer_message in consumer
     })
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         octo_group_name(printer_id),
         msg_dict,
     )
 
-def send_message_to_web(printer_id, msg_dict):
-    msg_dict.update({'type': 'web.message'})    # mapped to -> web_message in consumer
+def send_msg_to_printer(printer_id, msg_dict):
+    async_to_sync(send_msg_to_printer_async)(printer_id, msg_dict)
+
+def send_printer_changed_to_printer(printer_id):
     layer = get_channel_layer()
     async_to_sync(layer.group_send)(
-        web_group_name(printer_id),
-        msg_dict,
+        octo_group_name(printer_id),
+        {
+            'type': 'printer.changed',         # mapped to -> printer_changed in consumer
+        }
     )
 
-def send_status_to_web(printer_id):
+async def send_message_to_web_async(printer_id, msg_dict):
+    msg_dict.update({'type': 'web.message'})    # mapped to -> web_message in consumer
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         web_group_name(printer_id),
-        {
-            'type': 'printer.status',         # mapped to -> printer_status in consumer
-        }
+        msg_dict,
     )
 
-def send_janus_to_web(printer_id, msg):
+def send_message_to_web(printer_id, msg_dict):
+    async_to_sync(send_message_to_web_async)(printer_id, msg_dict)
+
+def send_status_to_web(printer_id):
+    '''
+    Status updates of a printer are usually bursty (status from the agent, then the pic, then the detection result...).
+    Updates within STATUS_COALESCE_SECS of the first one are coalesced into one, which is sent at the end of the window.
+    '''
+    status_fan_out.schedule(int(printer_id))
+
+
+class StatusFanOut:
+    """
+    Sends the coalesced status updates of all the printers from a single long-lived thread per process,
+    which keeps its own db connection open, instead of a thread and a db connection per update.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.has_pending = threading.Condition(self.lock)
+        self.due_at = {}  # printer_id -> when its coalesced status update is sent
+        self.thread = None
+
+    def schedule(self, printer_id):
+        with self.lock:
+            if printer_id in self.due_at:
+                return
+            self.due_at[printer_id] = time.monotonic() + STATUS_COALESCE_SECS
+
+            # Started lazily, so that it runs in the process that sends the updates (e.g. after forking)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='status-fan-out', daemon=True)
+                self.thread.start()
+            self.has_pending.notify()
+
+    def due_printer_ids(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                due = [printer_id for (printer_id, due_at) in self.due_at.items() if due_at <= now]
+                if due:
+                    for printer_id in due:
+                        del self.due_at[printer_id]
+                    return due
+                self.has_pending.wait(min(self.due_at.values()) - now if self.due_at else None)
+
+    def run(self):
+        while True:
+            printer_ids = self.due_printer_ids()
+            try:
+                fan_out_status(printer_ids)
+            except Exception:
+                LOGGER.exception(f'Failed to send status of printers {printer_ids} to web')
+                db.connection.close()  # In case it's broken, e.g. the db restarted. Reconnected by the next update.
+
+
+status_fan_out = StatusFanOut()
+
+
+def fan_out_status(printer_ids):
+    # Serialized once here, instead of by every web client connected to the printer
+    from app.models import Printer
+    from api.serializers import PrinterSerializer
+
+    printers = Printer.with_archived.filter(id__in=printer_ids).select_related('current_print')
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    for printer_data in PrinterSerializer(printers, many=True).data:
+        async_to_sync(layer.group_send)(
+            web_group_name(printer_data['id']),
+            {
+                'type': 'printer.status',         # mapped to -> printer_status in consumer
+                'printer': dict(printer_data),
+            }
+        )
+
+async def send_janus_to_web_async(printer_id, msg):
+    layer = get_channel_layer()
+    await layer.group_send(
         janus_web_group_name(printer_id),
         {
             'type': 'janus.message',         # mapped to -> janus_message in consumer
@@ -58,25 +143,49 @@ def send_janus_to_web(printer_id, msg):
         }
     )
 
+def send_janus_to_web(printer_id, msg):
+    async_to_sync(send_janus_to_web_async)(printer_id, msg)
 
-def send_message_to_octoprinttunnel(group_name, data):
+
+async def send_message_to_octoprinttunnel_async(group_name, data):
     msg_dict = {
         # mapped to -> octoprinttunnel_message in consumer
         'type': 'octoprinttunnel.message',
         'data': data
     }
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         group_name,
         msg_dict,
     )
 
+def send_message_to_octoprinttunnel(group_name, data):
+    async_to_sync(send_message_to_octoprinttunnel_async)(group_name, data)
+
+
+def add_ws_connection(group_name, channel_name):
+    if cache.presence_add(group_name, channel_name, time.time()):
+        broadcast_ws_connection_change(group_name)
+
+
+def remove_ws_connection(group_name, channel_name):
+    if cache.presence_remove(group_name, channel_name):
+        broadcast_ws_connection_change(group_name)
+
+
+def touch_ws_connection(group_name, channel_name):
+    cache.presence_touch(group_name, channel_name, time.time())
+
+
+def prune_ws_connections():
+    for group_name in cache.presence_prune(time.time()):
+        broadcast_ws_connection_change(group_name)
+
 
-@receiver(presence_changed)
-def broadcast_ws_connection_change(sender, room, **kwargs):
-    (group, printer_id) = room.channel_name.split('.')  # room.channel_name is actually the room name (= group name)
+def broadcast_ws_connection_change(group_name):
+    (group, printer_id) = group_name.split('.')
     if group == 'p_web':
-        send_msg_to_printer(printer_id, {'remote_status': {'viewing': room.get_anonymous_count() > 0}})
+        send_msg_to_printer(printer_id, {'remote_status': {'viewing': num_ws_connections(group_name) > 0}})
     if group == 'p_octo':
         if num_ws_connections(octo_group_name(printer_id)) <= 0:
             cache.printer_status_delete(printer_id)
@@ -84,5 +193,4 @@ def broadcast_ws_connection_change(sender, room, **kwargs):
 
 
 def num_ws_connections(group_name):
-    rooms = Room.objects.filter(channel_name=group_name)      # room.channel_name is actually the room name (= group name)
-    return rooms[0].get_anonymous_count() if len(rooms) > 0 else 0
+    return cache.presence_count(group_name)
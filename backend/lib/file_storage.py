@@ -4,19 +4,25 @@ import base64
 from six.moves.urllib.parse import urlencode, quote
 
 import importlib
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import backoff
 
 lt_file_storage = importlib.import_module(getattr(settings, 'LT_FILE_STORAGE_MODULE', 'lib.fs_file_storage'))
 st_file_storage = importlib.import_module(getattr(settings, 'ST_FILE_STORAGE_MODULE', 'lib.fs_file_storage'))
 
-def save_file_obj(dest_path, file_obj, container, long_term_storage=True):
+def content_type_of(dest_path):
     content_type='application/octet-stream'
     if dest_path.endswith('.jpg'):
         content_type='image/jpeg'
     if dest_path.endswith('.mp4'):
         content_type='video/mp4'
+    return content_type
 
+def save_file_obj(dest_path, file_obj, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
-    return file_storage.save_file_obj(dest_path, file_obj, container, content_type)
+    return file_storage.save_file_obj(dest_path, file_obj, container, content_type_of(dest_path))
 
 def list_dir(dir_path, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
@@ -34,3 +40,49 @@ def delete_dir(dir_path, container, long_term_storage=True):
 def delete_file(file_path, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
     return file_storage.delete_file(file_path, container)
+
+# Bulk operations. Storage modules can implement their own `retrieve_many`/`save_many`, e.g., to use a native batch API.
+# Otherwise the single file operations are run on a thread pool, up to settings.FILE_STORAGE_CONCURRENCY at a time,
+# each one tried up to settings.FILE_STORAGE_MAX_TRIES times.
+
+# Return: iterator of (src_path, BytesIO) in the same order as src_paths. Files are retrieved ahead of the iteration.
+# Note: silently ignore error if src_path does not exist. The BytesIO will be empty.
+def retrieve_many(src_paths, container, long_term_storage=True):
+    file_storage = lt_file_storage if long_term_storage else st_file_storage
+    if hasattr(file_storage, 'retrieve_many'):
+        return file_storage.retrieve_many(src_paths, container)
+
+    def retrieve(src_path):
+        file_obj = io.BytesIO()
+        file_storage.retrieve_to_file_obj(src_path, file_obj, container)
+        file_obj.seek(0)
+        return (src_path, file_obj)
+
+    return map_concurrently(retrieve, src_paths)
+
+# dest_paths_and_file_objs: iterable of (dest_path, file_obj). It's consumed as files are saved, hence it can be a generator that opens files lazily.
+# Return: list of (internal_url, external_url) in the same order as dest_paths_and_file_objs
+def save_many(dest_paths_and_file_objs, container, long_term_storage=True):
+    file_storage = lt_file_storage if long_term_storage else st_file_storage
+    files_to_save = ((dest_path, file_obj, content_type_of(dest_path)) for (dest_path, file_obj) in dest_paths_and_file_objs)
+    if hasattr(file_storage, 'save_many'):
+        return file_storage.save_many(files_to_save, container)
+
+    def save(file_to_save):
+        dest_path, file_obj, content_type = file_to_save
+        file_obj.seek(0)  # In case of a retry
+        return file_storage.save_file_obj(dest_path, file_obj, container, content_type)
+
+    return list(map_concurrently(save, files_to_save))
+
+def map_concurrently(fn, items):
+    concurrency = max(1, settings.FILE_STORAGE_CONCURRENCY)
+    fn_with_retries = backoff.on_exception(backoff.expo, Exception, max_tries=settings.FILE_STORAGE_MAX_TRIES)(fn)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn_with_retries, item))
+            if len(pending) >= concurrency * 2:  # Don't run too far ahead of the consumer, so that memory usage is bounded
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -2,6 +2,7 @@ from django.conf import settings
 import os
 from os import path
 from shutil import copyfileobj, rmtree
+import io
 
 from lib import site
 from lib.url_signing import new_signed_url
@@ -31,6 +32,17 @@ def retrieve_to_file_obj(src_path, file_obj, container):
     with open(fqp, 'rb') as src_file:
         copyfileobj(src_file, file_obj)
 
+# Local disk is fast enough for files to be read one by one, when they are iterated
+def retrieve_many(src_paths, container):
+    for src_path in src_paths:
+        file_obj = io.BytesIO()
+        retrieve_to_file_obj(src_path, file_obj, container)
+        file_obj.seek(0)
+        yield (src_path, file_obj)
+
+def save_many(files_to_save, container):
+    return [save_file_obj(dest_path, file_obj, container, content_type) for (dest_path, file_obj, content_type) in files_to_save]
+
 def delete_dir(dir_path, container):
     fqp = path.join(settings.MEDIA_ROOT, container, dir_path)
     rmtree(fqp, ignore_errors=True)
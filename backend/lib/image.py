@@ -1,4 +1,104 @@
-from PIL import ImageDraw
+import io
+from PIL import Image, ImageDraw
+
+MAX_PIC_SIZE = (1280, 960)
+MAX_PIC_DIMENSION_UNCAPPED = 1296
+
+
+class Pic:
+    '''
+    A JPEG picture that is decoded at most once, and only when pixels are actually needed.
+    It's file-like, so that it can be saved to storage or posted as it is. Everything but image() is the wrapped file's.
+    '''
+
+    def __init__(self, file_obj, img=None):
+        self.file_obj = file_obj
+        self.img = img
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+    def __iter__(self):
+        return iter(self.file_obj)
+
+    def __len__(self):
+        return len(self.file_obj)
+
+    def image(self):
+        '''
+        The decoded picture. Shared by all callers. Copy it before drawing on it.
+        '''
+        if self.img is None:
+            self.file_obj.seek(0)
+            self.img = Image.open(self.file_obj)
+            self.img.load()
+            self.file_obj.seek(0)
+        return self.img
+
+
+def open_image(file_obj):
+    if isinstance(file_obj, Pic):
+        return file_obj.image()
+    return Image.open(file_obj)
+
+
+def cap_image_size(file_obj):
+    '''
+    Downscale the picture if it's larger than MAX_PIC_SIZE. Pictures that are small enough are not even decoded,
+    as Image.open only parses the JPEG header.
+    '''
+    im = Image.open(file_obj)
+    if max(im.size) <= MAX_PIC_DIMENSION_UNCAPPED:
+        file_obj.seek(0)
+        return Pic(file_obj)
+
+    # Let the JPEG decoder downscale in the DCT domain (by 1/2, 1/4 or 1/8) as far as possible,
+    # so that only the remaining bit is done by the much more expensive resampling.
+    target_size = capped_size(im.size)
+    im.draft('RGB', target_size)
+    im.thumbnail(MAX_PIC_SIZE, Image.LANCZOS, reducing_gap=None)
+
+    output = io.BytesIO()
+    im.save(output, format='JPEG')
+    output.seek(0)
+    return Pic(output, img=im)
+
+
+def split_jpeg_stream(stream, chunk_size=1024*1024):
+    '''
+    Split a stream of concatenated JPEG files, such as the output of `ffmpeg -f image2pipe -c:v mjpeg`, into JPEG bytes.
+    Relies on the EOI marker not appearing inside a frame, which holds for the JPEGs ffmpeg encodes (no embedded thumbnails).
+    '''
+    buf = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        start = 0
+        while True:
+            eoi = buf.find(b'\xff\xd9', start)
+            if eoi < 0:
+                break
+            yield buf[start:eoi + 2]
+            start = eoi + 2
+        buf = buf[start:]
+
+
+def capped_size(size):
+    scale = min(MAX_PIC_SIZE[0] / size[0], MAX_PIC_SIZE[1] / size[1], 1)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def save_tagged_pic(file_obj, detections, dest, format='JPEG'):
+    '''
+    Render the detections on the pic and save it to dest, a file path or a file object.
+    '''
+    img = open_image(file_obj)
+    if isinstance(file_obj, Pic):
+        img = img.copy()  # The decoded image is shared. Don't draw on it
+    overlay_detections(img, detections).save(dest, format)
+
 
 def overlay_detections(img, detections):
     draw = ImageDraw.Draw(img)
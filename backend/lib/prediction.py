@@ -1,4 +1,5 @@
 import logging
+from datetime import datetime, timezone
 from django.conf import settings
 
 LOGGER = logging.getLogger(__name__)
@@ -18,6 +19,21 @@ def update_prediction_with_detections(prediction, detections):
     prediction.rolling_mean_short = next_rolling_mean(p, prediction.rolling_mean_short, prediction.current_frame_num, ROLLING_WIN_SHORT)
     prediction.rolling_mean_long = next_rolling_mean(p, prediction.rolling_mean_long, prediction.lifetime_frame_num, ROLLING_WIN_LONG)
 
+# The fields of PrinterPrediction that change frame by frame, in the order of the model definition
+PREDICTION_SNAPSHOT_FIELDS = ('current_frame_num', 'lifetime_frame_num', 'current_p', 'ewm_mean', 'rolling_mean_long', 'rolling_mean_short')
+
+def prediction_snapshot(prediction):
+    # Much cheaper than a copy.deepcopy of the model instance, when the prediction of every frame needs to be kept
+    return tuple(getattr(prediction, f) for f in PREDICTION_SNAPSHOT_FIELDS)
+
+def snapshots_to_serializable(snapshots, timestamps=None):
+    # Same structure as django.core.serializers.serialize('python', ...) of unsaved PrinterPrediction instances
+    updated_ats = [datetime.fromtimestamp(t, tz=timezone.utc).isoformat() for t in timestamps] if timestamps else [None] * len(snapshots)
+    return [
+        {'model': 'app.printerprediction', 'pk': None, 'fields': dict(zip(PREDICTION_SNAPSHOT_FIELDS, s), created_at=None, updated_at=updated_at)}
+        for s, updated_at in zip(snapshots, updated_ats)
+    ]
+
 def is_failing(prediction, detective_sensitivity, escalating_factor=1):
     if prediction.current_frame_num < settings.INIT_SAFE_FRAME_NUM:
         return False
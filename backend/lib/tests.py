@@ -1,9 +1,16 @@
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase
 from unittest.mock import patch
+from PIL import Image
+import io
+import json
+import os
+import time
 
 
 from app.models import User, HeaterTracker, Printer, Print
 from .heater_trackers import process_heater_temps
+from .image import split_jpeg_stream
+from . import cache, tunnel_codec
 
 
 class HeaterTrackerTestCase(TransactionTestCase):
@@ -225,3 +232,146 @@ class HeaterTrackerTestCase(TransactionTestCase):
 
         self.assertEqual(print.PrintHeaterTarget_set.first().name, 'h0')
         self.assertEqual(print.PrintHeaterTarget_set.first().target, 60.0)
+
+
+class SplitJpegStreamTestCase(SimpleTestCase):
+
+    def jpeg_bytes(self, color):
+        out = io.BytesIO()
+        Image.new('RGB', (64, 48), color).save(out, 'JPEG')
+        return out.getvalue()
+
+    def test_splits_concatenated_jpegs(self):
+        jpegs = [self.jpeg_bytes(color) for color in ('red', 'green', 'blue')]
+
+        # Chunks much smaller than a frame, so that frames, as well as EOI markers, straddle chunk boundaries
+        for chunk_size in (1, 7, 100, 1024*1024):
+            frames = list(split_jpeg_stream(io.BytesIO(b''.join(jpegs)), chunk_size=chunk_size))
+            self.assertEqual(frames, jpegs)
+
+        for (frame, color) in zip(frames, ((255, 0, 0), (0, 128, 0), (0, 0, 255))):
+            pixel = Image.open(io.BytesIO(frame)).getpixel((32, 24))
+            self.assertTrue(all(abs(a - b) < 8 for (a, b) in zip(pixel, color)))
+
+    def test_empty_stream(self):
+        self.assertEqual(list(split_jpeg_stream(io.BytesIO(b''))), [])
+
+    def test_trailing_partial_frame_is_dropped(self):
+        jpeg = self.jpeg_bytes('red')
+        frames = list(split_jpeg_stream(io.BytesIO(jpeg + jpeg[:100]), chunk_size=16))
+        self.assertEqual(frames, [jpeg])
+
+
+class TunnelCodecTestCase(SimpleTestCase):
+
+    def test_text_round_trip(self):
+        text = '{"current": {"state": "Printing"}} ' * 100
+        msg = tunnel_codec.encode(text)
+        self.assertEqual(msg['codec'], 'zlib')
+        self.assertIsInstance(msg['data'], bytes)
+        self.assertEqual(tunnel_codec.decode(msg), text)
+
+    def test_bytes_round_trip(self):
+        data = bytes(range(256)) * 10
+        msg = tunnel_codec.encode(data)
+        self.assertEqual(msg['codec'], 'zlib')
+        self.assertEqual(tunnel_codec.decode(msg), data)
+
+    def test_small_frame_not_compressed(self):
+        for data in ('ping', b'ping', None):
+            msg = tunnel_codec.encode(data)
+            self.assertIsNone(msg['codec'])
+            self.assertEqual(tunnel_codec.decode(msg), data)
+
+    def test_incompressible_frame_not_compressed(self):
+        data = os.urandom(4096)
+        msg = tunnel_codec.encode(data)
+        self.assertIsNone(msg['codec'])
+        self.assertEqual(tunnel_codec.decode(msg), data)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            tunnel_codec.decode({'data': b'', 'codec': 'zstd'})
+
+
+class PrinterStatusCacheTestCase(SimpleTestCase):
+
+    printer_id = 987654321
+    status = {
+        '_ts': 1690000000,
+        'state': {'text': 'Printing', 'flags': {'printing': True}},
+        'progress': {'completion': 42.0, 'printTime': 600},
+        'temperatures': {'tool0': {'actual': 210.0, 'target': 210.0}},
+        'job': {'file': {'name': 'benchy.gcode'}},
+    }
+
+    def tearDown(self):
+        cache.printer_status_delete(self.printer_id)
+
+    def test_no_status(self):
+        self.assertEqual(cache.printer_status_get(self.printer_id), {})
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'state'))
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'job'))
+
+    def test_legacy_hash(self):
+        cache.printer_status_set(self.printer_id, {k: json.dumps(v) for k, v in self.status.items() if k != '_ts'}, ex=60)
+
+        self.assertEqual(cache.printer_status_get(self.printer_id), {k: v for k, v in self.status.items() if k != '_ts'})
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'state'), self.status['state'])
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'job'), self.status['job'])
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'currentZ'))
+
+    def test_hot_fields_and_doc(self):
+        cache.printer_status_doc_set(self.printer_id, self.status, ex=60)
+
+        self.assertEqual(cache.printer_status_get(self.printer_id), self.status)
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'state'), self.status['state'])
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'temperatures'), self.status['temperatures'])
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'job'), self.status['job'])
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'currentZ'))
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'file_metadata'))
+
+    def test_doc_takes_precedence_over_legacy_hash(self):
+        cache.printer_status_set(self.printer_id, {'state': json.dumps({'text': 'Operational'}), 'currentZ': '1.2'}, ex=60)
+        cache.printer_status_doc_set(self.printer_id, self.status, ex=60)
+
+        self.assertEqual(cache.printer_status_get(self.printer_id), self.status)
+        self.assertEqual(cache.printer_status_get(self.printer_id, 'state'), self.status['state'])
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'currentZ'))
+
+    def test_hot_fields_dropped_from_a_newer_status(self):
+        cache.printer_status_doc_set(self.printer_id, self.status, ex=60)
+        cache.printer_status_doc_set(self.printer_id, {'_ts': 1690000001, 'state': {'text': 'Operational'}}, ex=60)
+
+        self.assertEqual(cache.printer_status_get(self.printer_id), {'_ts': 1690000001, 'state': {'text': 'Operational'}})
+        self.assertIsNone(cache.printer_status_get(self.printer_id, 'progress'))
+
+
+class PrintPredictionsCacheTestCase(SimpleTestCase):
+
+    print_id = 987654321
+
+    def tearDown(self):
+        cache.print_predictions_delete(self.print_id)
+
+    def test_no_predictions(self):
+        self.assertEqual(cache.print_predictions_get(self.print_id), {})
+
+    def test_predictions_in_order_appended(self):
+        cache.print_prediction_append(self.print_id, '200', (1, 1, 0.1, 0.1, 0.1, 0.1), [['failure', 0.5, [1, 2, 3, 4]]])
+        cache.print_prediction_append(self.print_id, '100', (2, 2, 0.2, 0.2, 0.2, 0.2), [])
+
+        predictions = cache.print_predictions_get(self.print_id)
+        self.assertEqual(list(predictions.keys()), ['200', '100'])
+
+        (timestamp, snapshot, detections) = predictions['200']
+        self.assertAlmostEqual(timestamp, time.time(), delta=60)
+        self.assertEqual(snapshot, (1, 1, 0.1, 0.1, 0.1, 0.1))
+        self.assertEqual(detections, [['failure', 0.5, [1, 2, 3, 4]]])
+        self.assertEqual(predictions['100'][1:], ((2, 2, 0.2, 0.2, 0.2, 0.2), []))
+        self.assertLessEqual(timestamp, predictions['100'][0])
+
+    def test_deleted(self):
+        cache.print_prediction_append(self.print_id, '100', (1, 1, 0.1, 0.1, 0.1, 0.1), [])
+        cache.print_predictions_delete(self.print_id)
+        self.assertEqual(cache.print_predictions_get(self.print_id), {})
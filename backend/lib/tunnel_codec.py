@@ -0,0 +1,43 @@
+import zlib
+
+import newrelic.agent
+
+# Codecs of the ws.tunnel relay, offered to the agent in the 'connect' message of a tunnel.
+# An agent that accepts them sends its ws.tunnel messages with a 'codec' field (None when the frame isn't compressed),
+# and from then on the frames from the browser are compressed for it too.
+CODECS = ('zlib',)
+
+# Smaller frames are not worth compressing
+MIN_COMPRESS_BYTES = 256
+
+
+def encode(data):
+    """
+    Returns the fields of the ws.tunnel message for the frame: {'data': ..., 'codec': ..., 'text': ...}
+    """
+    is_text = isinstance(data, str)
+    raw = data.encode('utf-8') if is_text else data
+    if raw is None or len(raw) < MIN_COMPRESS_BYTES:
+        return {'data': data, 'codec': None}
+
+    compressed = zlib.compress(raw)
+    if len(compressed) >= len(raw):
+        return {'data': data, 'codec': None}
+
+    newrelic.agent.record_custom_metric('Custom/OctoPrintTunnel/WsBytesSaved/ToAgent', len(raw) - len(compressed))
+    return {'data': compressed, 'codec': 'zlib', 'text': is_text}
+
+
+def decode(msg):
+    """
+    Returns the frame of the ws.tunnel message, text or binary as the frame it was made of.
+    """
+    if msg.get('codec') is None:
+        return msg['data']
+
+    if msg['codec'] != 'zlib':
+        raise ValueError(f'Unknown ws.tunnel codec {msg["codec"]}')
+
+    raw = zlib.decompress(msg['data'])
+    newrelic.agent.record_custom_metric('Custom/OctoPrintTunnel/WsBytesSaved/FromAgent', len(raw) - len(msg['data']))
+    return raw.decode('utf-8') if msg.get('text', False) else raw
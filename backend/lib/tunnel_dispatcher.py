@@ -0,0 +1,191 @@
+import collections
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from django.conf import settings
+import newrelic.agent
+
+from . import cache
+
+LOGGER = logging.getLogger(__name__)
+
+# Redis is not read for a response that has this many messages not yet consumed by the view, until it catches up
+MAX_QUEUED_MESSAGES = 4
+
+# Upper bound of how long the dispatcher blocks in redis before it picks up changes in the responses to wait for
+READ_BLOCK_SECS = 5
+
+
+class PendingResponse:
+
+    def __init__(self, printer_id, queued_secs, queue_depth):
+        self.printer_id = printer_id
+        self.started_at = time.time()
+        self.queued_secs = queued_secs  # How long it waited for the printer to have room for one more request in flight
+        self.queue_depth = queue_depth  # Requests in flight to, or waiting for, the printer when it arrived
+        self.first_message_at = None
+        self.messages = queue.Queue()
+        self.last_id = '0'
+        self.paused = False
+
+
+class TunnelResponseDispatcher:
+    """
+    Waits on the responses to all the tunnel requests in flight in this process with a single redis connection,
+    and hands each response message over to the request thread it's for.
+    Also caps the number of requests in flight per printer, so that a slow printer can't tie up all the web workers.
+    Requests over the cap wait, up to OCTOPRINT_TUNNEL_INFLIGHT_WAIT_SECS, for the ones in flight to finish.
+    At most OCTOPRINT_TUNNEL_MAX_WAITING_PER_PRINTER of them wait at a time. Any more are turned away right away.
+
+    Each request is recorded as an OctoPrintTunnelRequest custom event, so that the distributions of its latency,
+    duration, queueing time and queue depth can be queried, e.g. with NRQL histogram().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.has_responses = threading.Condition(self.lock)
+        self.has_room = threading.Condition(self.lock)
+        self.responses = {}  # ref -> PendingResponse
+        self.inflight_per_printer = collections.Counter()
+        self.waiting_per_printer = collections.Counter()
+        self.wake_ref = f'dispatcher.{uuid.uuid4().hex}'  # Message to this ref interrupts the dispatcher's blocking read
+        self.thread = None
+
+    def begin(self, printer_id, ref):
+        """
+        Returns False, without starting the request, if the printer has too many requests in flight and either
+        too many waiting already, or still too many in flight after OCTOPRINT_TUNNEL_INFLIGHT_WAIT_SECS.
+        """
+        arrived_at = time.monotonic()
+        deadline = arrived_at + settings.OCTOPRINT_TUNNEL_INFLIGHT_WAIT_SECS
+        with self.lock:
+            queue_depth = self.inflight_per_printer[printer_id] + self.waiting_per_printer[printer_id]
+            if (self.inflight_per_printer[printer_id] >= settings.OCTOPRINT_TUNNEL_MAX_INFLIGHT_PER_PRINTER
+                    and self.waiting_per_printer[printer_id] >= settings.OCTOPRINT_TUNNEL_MAX_WAITING_PER_PRINTER):
+                self.record_rejected(printer_id, 0, queue_depth)
+                return False
+
+            self.waiting_per_printer[printer_id] += 1
+            try:
+                while self.inflight_per_printer[printer_id] >= settings.OCTOPRINT_TUNNEL_MAX_INFLIGHT_PER_PRINTER:
+                    time_left = deadline - time.monotonic()
+                    if time_left <= 0:
+                        self.record_rejected(printer_id, time.monotonic() - arrived_at, queue_depth)
+                        return False
+                    self.has_room.wait(time_left)
+            finally:
+                self.waiting_per_printer[printer_id] -= 1
+                if self.waiting_per_printer[printer_id] <= 0:
+                    del self.waiting_per_printer[printer_id]
+
+            self.inflight_per_printer[printer_id] += 1
+            self.responses[ref] = PendingResponse(printer_id, time.monotonic() - arrived_at, queue_depth)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='tunnel-dispatcher', daemon=True)
+                self.thread.start()
+            self.has_responses.notify()
+
+        self.wake()
+        return True
+
+    def record_rejected(self, printer_id, queued_secs, queue_depth):
+        newrelic.agent.record_custom_metric('Custom/OctoPrintTunnel/Rejected', 1)
+        newrelic.agent.record_custom_event('OctoPrintTunnelRequest', {
+            'printer_id': printer_id,
+            'rejected': True,
+            'queued_secs': queued_secs,
+            'queue_depth': queue_depth,
+        })
+
+    def queued_secs(self, ref):
+        return self.responses[ref].queued_secs
+
+    def end(self, ref):
+        with self.lock:
+            pending = self.responses.pop(ref, None)
+            if pending is None:
+                return
+
+            self.inflight_per_printer[pending.printer_id] -= 1
+            if self.inflight_per_printer[pending.printer_id] <= 0:
+                del self.inflight_per_printer[pending.printer_id]
+            self.has_room.notify_all()
+
+        ended_at = time.time()
+        newrelic.agent.record_custom_event('OctoPrintTunnelRequest', {
+            'printer_id': pending.printer_id,
+            'rejected': False,
+            'queued_secs': pending.queued_secs,
+            'queue_depth': pending.queue_depth,
+            'latency_secs': (pending.first_message_at or ended_at) - pending.started_at,
+            'duration_secs': ended_at - pending.started_at,
+            'responded': pending.first_message_at is not None,
+        })
+        cache.octoprinttunnel_http_response_delete(ref)
+
+    def read(self, ref, timeout_secs):
+        """
+        Returns the next messages of the response, or [] if none comes within timeout_secs.
+        """
+        pending = self.responses[ref]
+        try:
+            msgs = [pending.messages.get(timeout=timeout_secs)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                msgs.append(pending.messages.get_nowait())
+            except queue.Empty:
+                break
+
+        if pending.first_message_at is None:
+            pending.first_message_at = time.time()
+
+        with self.lock:
+            was_paused, pending.paused = pending.paused, False
+        if was_paused:
+            self.wake()
+
+        return msgs
+
+    def wake(self):
+        cache.octoprinttunnel_http_response_set(self.wake_ref, {})
+
+    def run(self):
+        last_wake_id = '0'
+        while True:
+            try:
+                with self.lock:
+                    while not self.responses:
+                        self.has_responses.wait()
+
+                    last_ids = {self.wake_ref: last_wake_id}
+                    for ref, pending in self.responses.items():
+                        if pending.messages.qsize() >= MAX_QUEUED_MESSAGES:
+                            pending.paused = True
+                        else:
+                            last_ids[ref] = pending.last_id
+
+                for ref, msgs in cache.octoprinttunnel_http_responses_read(last_ids, timeout_secs=READ_BLOCK_SECS).items():
+                    if ref == self.wake_ref:
+                        last_wake_id = msgs[-1][0]
+                        continue
+
+                    pending = self.responses.get(ref)
+                    if pending is None:  # Already ended
+                        continue
+
+                    pending.last_id = msgs[-1][0]
+                    for (_, data) in msgs:
+                        pending.messages.put(data)
+            except Exception:
+                LOGGER.exception('Failed to read tunnel responses')
+                time.sleep(1)
+
+
+dispatcher = TunnelResponseDispatcher()
@@ -13,8 +13,13 @@ from datetime import timedelta
 from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import backoff
+import requests
 
 from lib.file_storage import list_dir, retrieve_to_file_obj, save_file_obj
+from lib.image import open_image, save_tagged_pic
+from lib.url_signing import new_signed_url
+from lib import site
+from lib import cache
 
 # Return dict if not empty, otherwise None.
 def dict_or_none(dict_value):
@@ -32,6 +37,30 @@ def ml_api_auth_headers():
     return {"Authorization": "Bearer {}".format(settings.ML_API_TOKEN)} if settings.ML_API_TOKEN else {}
 
 
+def ml_api_detect(img_bytes=None, img_url=None):
+    if settings.ML_API_POST_IMAGE and img_bytes is not None:
+        headers = dict(ml_api_auth_headers(), **{'Content-Type': 'image/jpeg'})
+        req = requests.post(settings.ML_API_HOST + '/p/', data=img_bytes, headers=headers, verify=False)
+    else:
+        req = requests.get(settings.ML_API_HOST + '/p/', params={'img': img_url}, headers=ml_api_auth_headers(), verify=False)
+    req.raise_for_status()
+    return req.json()['detections']
+
+
+def ml_api_detect_batch(imgs_bytes=None, img_urls=None):
+    '''
+    Return: list of detections, one for each of imgs_bytes, or img_urls if the ML API doesn't take posted images
+    '''
+    if settings.ML_API_POST_IMAGE and imgs_bytes is not None:
+        files = [('img', (f'{i}.jpg', img_bytes, 'image/jpeg')) for i, img_bytes in enumerate(imgs_bytes)]
+        req = requests.post(settings.ML_API_HOST + '/p/batch/', files=files, headers=ml_api_auth_headers(), verify=False)
+        req.raise_for_status()
+        return req.json()['detections']
+
+    # ML API older than the server has no batch endpoint
+    return [ml_api_detect(img_url=img_url) for img_url in img_urls]
+
+
 def orientation_to_ffmpeg_options(printer_settings):
     options = '-vf pad=ceil(iw/2)*2:ceil(ih/2)*2'
 
@@ -91,8 +120,9 @@ def copy_pic(input_path, dest_jpg_path, rotated=False, printer_settings=None, to
 def save_pic(dest_jpg_path, img_bytes, rotated=False, printer_settings=None, to_container=settings.PICS_CONTAINER, to_long_term_storage=True):
     bytes_to_save = img_bytes
 
-    if rotated:
-        tmp_img = Image.open(bytes_to_save)
+    # Nothing to decode and re-encode if the webcam is mounted as is
+    if rotated and (printer_settings['webcam_flipH'] or printer_settings['webcam_flipV'] or printer_settings['webcam_rotation']):
+        tmp_img = open_image(bytes_to_save)  # Reuses the decoded image if it's a lib.image.Pic
         if printer_settings['webcam_flipH']:
             tmp_img = tmp_img.transpose(Image.FLIP_LEFT_RIGHT)
         if printer_settings['webcam_flipV']:
@@ -108,6 +138,44 @@ def save_pic(dest_jpg_path, img_bytes, rotated=False, printer_settings=None, to_
     return dest_jpg_url
 
 
+def tagged_pic_url(printer_id, print_id, pic_id):
+    # Tagged pics are not stored. They are rendered from the raw pic when they are first requested, and kept in redis for a while
+    return new_signed_url(site.build_full_url(f'/tagged_pics/{printer_id}/{print_id}/{pic_id}.jpg'))
+
+
+def render_tagged_pic(printer_id, print_id, pic_id):
+    '''
+    Return: the raw pic with the detections appended to the prediction series of the print rendered on it,
+    the stored tagged pic if the pic predates the series, or None if the raw pic is gone.
+    '''
+    # Pics never change. The same rendering is served to all the viewers of a pic
+    tagged_jpg = cache.print_tagged_pic_get(print_id, pic_id)
+    if tagged_jpg:
+        return io.BytesIO(tagged_jpg)
+
+    detections = cache.print_prediction_detections_get(print_id, pic_id)
+    if detections is None:
+        # Pics detected before the prediction series was in place have their tagged pics already rendered and stored
+        tagged_pic = io.BytesIO()
+        retrieve_to_file_obj(f'tagged/{printer_id}/{print_id}/{pic_id}.jpg', tagged_pic, settings.PICS_CONTAINER, long_term_storage=False)
+        if tagged_pic.getbuffer().nbytes:
+            tagged_pic.seek(0)
+            return tagged_pic
+        detections = []
+
+    raw_pic = io.BytesIO()
+    retrieve_to_file_obj(f'raw/{printer_id}/{print_id}/{pic_id}.jpg', raw_pic, settings.PICS_CONTAINER, long_term_storage=False)
+    if not raw_pic.getbuffer().nbytes:
+        return None
+    raw_pic.seek(0)
+
+    tagged_pic = io.BytesIO()
+    save_tagged_pic(raw_pic, detections, tagged_pic)
+    cache.print_tagged_pic_set(print_id, pic_id, tagged_pic.getvalue())
+    tagged_pic.seek(0)
+    return tagged_pic
+
+
 def get_rotated_pic_url(printer, jpg_url=None, force_snapshot=False):
     if not jpg_url:
         if not printer.pic or not printer.pic.get('img_url'):
@@ -120,8 +188,21 @@ def get_rotated_pic_url(printer, jpg_url=None, force_snapshot=False):
     if not need_rotation and not force_snapshot:
         return jpg_url
 
-    jpg_path = re.search('tsd-pics/(raw/\d+/[\d\.\/]+.jpg|tagged/\d+/[\d\.\/]+.jpg|snapshots/\d+/\w+.jpg)', jpg_url)
     file_prefix = str(timezone.now().timestamp()) if force_snapshot else 'latest'
+    tagged_pic = re.search('tagged_pics/(\d+)/(\d+)/([\d\.]+).jpg', jpg_url)
+    if tagged_pic:
+        tagged_img = render_tagged_pic(*tagged_pic.groups())
+        if not tagged_img:
+            return None
+        return save_pic(
+                f'snapshots/{printer.id}/{file_prefix}_rotated.jpg',
+                tagged_img,
+                rotated=True,
+                printer_settings=printer.settings,
+                to_long_term_storage=False
+            )
+
+    jpg_path = re.search('tsd-pics/(raw/\d+/[\d\.\/]+.jpg|tagged/\d+/[\d\.\/]+.jpg|snapshots/\d+/\w+.jpg)', jpg_url)
     return copy_pic(
                 jpg_path.group(1),
                 f'snapshots/{printer.id}/{file_prefix}_rotated.jpg',
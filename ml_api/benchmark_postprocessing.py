@@ -0,0 +1,171 @@
+#!python3
+# Micro-benchmark of OnnxNet post processing, the current implementation (a single sort for all classes, array ops
+# for the conversion of boxes) vs the original one (sort and NMS per class, boxes converted one by one).
+#
+# Record model outputs once:
+#   python benchmark_postprocessing.py --record-from image.jpg --outputs outputs.npz
+# Then benchmark on the recorded outputs:
+#   python benchmark_postprocessing.py --outputs outputs.npz
+# Without --outputs, random outputs of a similar shape are generated.
+import argparse
+import time
+import numpy as np
+import cv2
+
+from lib.onnx import post_processing
+
+
+def nms_cpu_legacy(boxes, confs, nms_thresh=0.5, min_mode=False):
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = confs.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        idx_self = order[0]
+        idx_other = order[1:]
+
+        keep.append(idx_self)
+
+        xx1 = np.maximum(x1[idx_self], x1[idx_other])
+        yy1 = np.maximum(y1[idx_self], y1[idx_other])
+        xx2 = np.minimum(x2[idx_self], x2[idx_other])
+        yy2 = np.minimum(y2[idx_self], y2[idx_other])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+
+        if min_mode:
+            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
+        else:
+            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+
+        inds = np.where(over <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep)
+
+
+def post_processing_legacy(output, width, height, conf_thresh, nms_thresh, names):
+    box_array = output[0]
+    confs = output[1]
+
+    num_classes = confs.shape[2]
+    box_array = box_array[:, :, 0]
+    max_conf = np.max(confs, axis=2)
+    max_id = np.argmax(confs, axis=2)
+
+    box_x1x1x2y2_to_xcycwh_scaled = lambda b: \
+        (
+            float(0.5 * width * (b[0] + b[2])),
+            float(0.5 * height * (b[1] + b[3])),
+            float(width * (b[2] - b[0])),
+            float(width * (b[3] - b[1]))
+         )
+    dets_batch = []
+    for i in range(box_array.shape[0]):
+        argwhere = max_conf[i] > conf_thresh
+        l_box_array = box_array[i, argwhere, :]
+        l_max_conf = max_conf[i, argwhere]
+        l_max_id = max_id[i, argwhere]
+
+        bboxes = []
+        for j in range(num_classes):
+            cls_argwhere = l_max_id == j
+            ll_box_array = l_box_array[cls_argwhere, :]
+            ll_max_conf = l_max_conf[cls_argwhere]
+            ll_max_id = l_max_id[cls_argwhere]
+
+            keep = nms_cpu_legacy(ll_box_array, ll_max_conf, nms_thresh)
+
+            if (keep.size > 0):
+                ll_box_array = ll_box_array[keep, :]
+                ll_max_conf = ll_max_conf[keep]
+                ll_max_id = ll_max_id[keep]
+
+                for k in range(ll_box_array.shape[0]):
+                    bboxes.append([ll_box_array[k, 0], ll_box_array[k, 1], ll_box_array[k, 2], ll_box_array[k, 3], ll_max_conf[k], ll_max_conf[k], ll_max_id[k]])
+
+        detections = [(names[b[6]], float(b[4]), box_x1x1x2y2_to_xcycwh_scaled((b[0], b[1], b[2], b[3]))) for b in bboxes]
+        dets_batch.append(detections)
+
+    return dets_batch
+
+
+def record_outputs(image_path, weights_path, outputs_path):
+    from lib.detection_model import load_net
+    net = load_net('model/model.cfg', 'model/model.meta', weights_path=weights_path)
+    input_shape = net.session.get_inputs()[0].shape
+    image = cv2.imread(image_path)
+    resized = cv2.resize(image, (input_shape[3], input_shape[2]), interpolation=cv2.INTER_LINEAR)
+    img_in = np.expand_dims(np.transpose(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB), (2, 0, 1)).astype(np.float32) / 255.0, axis=0)
+    boxes, confs = net.session.run(None, {net.session.get_inputs()[0].name: img_in})[:2]
+    np.savez(outputs_path, boxes=boxes, confs=confs, width=image.shape[1], height=image.shape[0])
+
+
+def synthetic_outputs(num_boxes, num_classes, num_objects=50, seed=0):
+    # Candidates are jittered around a few objects, like the raw outputs of a YOLO net
+    rng = np.random.default_rng(seed)
+    centers = rng.random((num_objects, 2), dtype=np.float32) * 0.8 + 0.1
+    sizes = rng.random((num_objects, 2), dtype=np.float32) * 0.15 + 0.02
+    obj = rng.integers(0, num_objects, num_boxes)
+    xy = centers[obj] + rng.normal(0, 0.02, (num_boxes, 2)).astype(np.float32)
+    wh = sizes[obj] * rng.uniform(0.7, 1.3, (num_boxes, 2)).astype(np.float32)
+    boxes = np.concatenate((xy - wh / 2, xy + wh / 2), axis=1).reshape(1, num_boxes, 1, 4)
+    confs = rng.random((1, num_boxes, num_classes), dtype=np.float32)
+    return dict(boxes=boxes, confs=confs, width=1280, height=720)
+
+
+def timed(fn, repeat):
+    # The fastest run, as the median of sub-millisecond runs is dominated by scheduling noise
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - started_at)
+    return result, min(durations)
+
+
+def same_detections(a, b):
+    if len(a) != len(b):
+        return False
+    return all(da[0] == db[0] and np.isclose(da[1], db[1]) and np.allclose(da[2], db[2], rtol=1e-5, atol=1e-3) for da, db in zip(a, b))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outputs", type=str, help="Recorded model outputs (.npz)")
+    parser.add_argument("--record-from", type=str, help="Run the net on this image and save its outputs to --outputs")
+    parser.add_argument("--weights", type=str, help="Model weights file, used with --record-from")
+    parser.add_argument("--synthetic-boxes", type=int, default=2535, help="Number of candidate boxes when generating random outputs")
+    parser.add_argument("--synthetic-classes", type=int, default=1, help="Number of classes when generating random outputs")
+    parser.add_argument("--synthetic-objects", type=int, default=50, help="Number of objects candidate boxes are scattered around when generating random outputs")
+    parser.add_argument("--det-threshold", type=float, default=0.08, help="Detection threshold")
+    parser.add_argument("--nms-threshold", type=float, default=0.45, help="NMS threshold")
+    parser.add_argument("--repeat", type=int, default=50, help="Number of runs per implementation")
+    opt = parser.parse_args()
+
+    if opt.record_from:
+        record_outputs(opt.record_from, opt.weights, opt.outputs)
+
+    if opt.outputs:
+        recorded = np.load(opt.outputs)
+        outputs = dict((k, recorded[k]) for k in recorded.files)
+    else:
+        outputs = synthetic_outputs(opt.synthetic_boxes, opt.synthetic_classes, opt.synthetic_objects)
+
+    names = ['class_{}'.format(i) for i in range(outputs['confs'].shape[2])]
+    args = ([outputs['boxes'], outputs['confs']], int(outputs['width']), int(outputs['height']), opt.det_threshold, opt.nms_threshold, names)
+    print(f"Candidate boxes: {outputs['boxes'].shape[1]} - above threshold: {int((outputs['confs'].max(axis=2) > opt.det_threshold).sum())}")
+
+    legacy_dets, legacy_secs = timed(lambda: post_processing_legacy(*args), opt.repeat)
+    dets, secs = timed(lambda: post_processing(*args), opt.repeat)
+
+    print(f"legacy:     {legacy_secs * 1000:.3f} ms - detection count: {len(legacy_dets[0])}")
+    print(f"current:    {secs * 1000:.3f} ms - detection count: {len(dets[0])}")
+    print(f"speedup: {legacy_secs / secs:.1f}x - same detections: {same_detections(legacy_dets[0], dets[0])}")
@@ -0,0 +1,78 @@
+#!python3
+# Throughput/latency benchmark of the net under different serving configurations.
+#
+# Every combination of the given settings is run for --duration seconds. Each worker process loads its own net,
+# like gunicorn workers do, and detects frames back to back. Example:
+#   python benchmark_serving.py frame.jpg --workers 1,2,4 --intra-op-threads 0,1,2 --execution-mode sequential,parallel
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+import numpy as np
+import cv2
+
+
+def run_worker(args):
+    image_path, weights, onnx_options, batch_size, duration, start_at = args
+    from lib.detection_model import load_net, detect_batch, warm_up
+
+    net = load_net('model/model.cfg', 'model/model.meta', weights_path=weights, onnx_options=onnx_options)
+    warm_up(net)
+    images = [cv2.imread(image_path)] * batch_size
+
+    # All workers start at the same time so that they compete for the CPU for the whole duration
+    time.sleep(max(0, start_at - time.time()))
+    latencies = []
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        started_at = time.perf_counter()
+        detect_batch(net, images, thresh=0.08)
+        latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def run_config(opt, workers, onnx_options, batch_size):
+    ctx = multiprocessing.get_context('spawn')
+    start_at = time.time() + opt.load_secs
+    with ctx.Pool(workers) as pool:
+        results = pool.map(run_worker, [(opt.image, opt.weights, onnx_options, batch_size, opt.duration, start_at)] * workers)
+
+    latencies = np.array([l for worker_latencies in results for l in worker_latencies])
+    frames = len(latencies) * batch_size
+    return dict(
+        fps=frames / opt.duration,
+        p50_ms=np.percentile(latencies, 50) * 1000,
+        p99_ms=np.percentile(latencies, 99) * 1000,
+    )
+
+
+def int_list(v):
+    return [int(i) for i in v.split(',')]
+
+
+def str_list(v):
+    return [i or None for i in v.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", type=str, help="Image file path")
+    parser.add_argument("--weights", type=str, help="Model weights file")
+    parser.add_argument("--workers", type=int_list, default=[1], help="Comma separated numbers of worker processes")
+    parser.add_argument("--intra-op-threads", type=int_list, default=[0], help="Comma separated intra op thread counts. 0: ONNX Runtime default")
+    parser.add_argument("--inter-op-threads", type=int_list, default=[0], help="Comma separated inter op thread counts. 0: ONNX Runtime default")
+    parser.add_argument("--execution-mode", type=str_list, default=[None], help="Comma separated execution modes: sequential, parallel")
+    parser.add_argument("--graph-optimization-level", type=str_list, default=[None], help="Comma separated levels: disable, basic, extended, all")
+    parser.add_argument("--batch-size", type=int_list, default=[1], help="Comma separated numbers of frames per run")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run each configuration")
+    parser.add_argument("--load-secs", type=float, default=15, help="Seconds allowed for workers to load and warm up the net")
+    opt = parser.parse_args()
+
+    print(f'CPU count: {os.cpu_count()}')
+    print('workers | intra | inter | mode       | opt level | batch |  frames/s |  p50 ms |  p99 ms')
+    for workers, intra, inter, mode, level, batch_size in itertools.product(
+            opt.workers, opt.intra_op_threads, opt.inter_op_threads, opt.execution_mode, opt.graph_optimization_level, opt.batch_size):
+        onnx_options = dict(intra_op_threads=intra, inter_op_threads=inter, execution_mode=mode, graph_optimization_level=level)
+        r = run_config(opt, workers, onnx_options, batch_size)
+        print(f"{workers:>7} | {intra:>5} | {inter:>5} | {mode or 'default':<10} | {level or 'default':<9} | {batch_size:>5} | {r['fps']:>9.2f} | {r['p50_ms']:>7.1f} | {r['p99_ms']:>7.1f}")
@@ -0,0 +1,15 @@
+# Gunicorn settings for the ML API: `gunicorn -c gunicorn.conf.py wsgi`
+from os import environ
+
+bind = '0.0.0.0:3333'
+
+# Each worker process loads and warms up its own copy of the model with the same settings from the environment (see server.py).
+# The app is deliberately not preloaded in the master: ONNX Runtime and darknet sessions are not safe to use after fork().
+workers = int(environ.get('ML_API_WORKERS', 1))
+preload_app = False
+
+# Concurrent requests within a worker are coalesced into batches
+threads = int(environ.get('ML_API_THREADS', 8))
+
+# Loading the model can take a while on slow boxes
+timeout = int(environ.get('ML_API_WORKER_TIMEOUT', 120))
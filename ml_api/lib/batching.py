@@ -0,0 +1,75 @@
+from concurrent.futures import Future
+from typing import Callable, List
+import queue
+import threading
+import time
+
+
+class BatchScheduler:
+    """
+    Coalesces frames submitted from concurrent requests into a single batched inference.
+
+    The first frame that arrives opens a batch. The batch is run as soon as it is full,
+    or when `max_wait_ms` has passed since it was opened, whichever comes first.
+    """
+
+    def __init__(self, run_batch: Callable[[List], List], max_batch_size: int = 8, max_wait_ms: float = 5):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_secs = max(0, max_wait_ms) / 1000.0
+        self.pending = queue.Queue()
+        self.worker = None
+        self.worker_lock = threading.Lock()
+
+    def submit(self, image) -> Future:
+        return self.submit_many([image])[0]
+
+    def submit_many(self, images) -> List[Future]:
+        """Frames submitted together are queued back to back, so that they are not split across batch windows."""
+        self.ensure_worker()
+        futures = [Future() for _ in images]
+        for (image, future) in zip(images, futures):
+            self.pending.put((image, future))
+        return futures
+
+    def ensure_worker(self):
+        # Started lazily so that the thread is created in the process that serves requests (e.g. after gunicorn forks)
+        with self.worker_lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.loop, name='batch-scheduler', daemon=True)
+                self.worker.start()
+
+    def loop(self):
+        while True:
+            self.run_once(self.collect())
+
+    def collect(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait_secs
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run_once(self, batch):
+        batch = [(image, future) for (image, future) in batch if future.set_running_or_notify_cancel()]
+        if batch:
+            self.run_running(batch)
+
+    def run_running(self, batch):
+        try:
+            results = self.run_batch([image for (image, _) in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Run the frames one by one, so that a bad frame only fails its own request
+            for item in batch:
+                self.run_running([item])
+            return
+
+        for ((_, future), result) in zip(batch, results):
+            future.set_result(result)
@@ -4,6 +4,7 @@
 from enum import Enum
 from lib.meta import Meta
 from os import path
+import numpy as np
 
 alt_names = None
 
@@ -22,7 +23,10 @@ except Exception as e:
     onnx_ready = False
 
 
-def load_net(config_path, meta_path, weights_path=None):
+def load_net(config_path, meta_path, weights_path=None, onnx_options=None):
+    '''
+    onnx_options: kwargs of lib.onnx.session_options(), e.g. dict(intra_op_threads=2). Ignored for darknet nets.
+    '''
 
     def try_loading_net(net_config_priority):
         for net_config in net_config_priority:
@@ -35,7 +39,7 @@ def load_net(config_path, meta_path, weights_path=None):
                 if weights.endswith(".onnx"):
                     if not onnx_ready:
                         raise Exception('Not loading ONNX net due to previous import failure. Check earlier log for errors.')
-                    net_main = OnnxNet(weights, meta_path, use_gpu)
+                    net_main = OnnxNet(weights, meta_path, use_gpu, options=onnx_options)
 
                 elif weights.endswith(".darknet"):
                     if not darknet_ready:
@@ -80,3 +84,14 @@ def load_net(config_path, meta_path, weights_path=None):
 def detect(net, image, thresh=.5, hier_thresh=.5, nms=.45, debug=False):
     return net.detect(net.meta, image, alt_names, thresh, hier_thresh, nms, debug)
 
+
+def detect_batch(net, images, thresh=.5, hier_thresh=.5, nms=.45, debug=False):
+    if hasattr(net, 'detect_batch'):
+        return net.detect_batch(net.meta, images, alt_names, thresh, hier_thresh, nms, debug)
+
+    # Darknet net is loaded with batch size = 1
+    return [net.detect(net.meta, image, alt_names, thresh, hier_thresh, nms, debug) for image in images]
+
+def warm_up(net, width=640, height=480):
+    # The first run initializes lazily allocated resources and is much slower than the following ones
+    detect_batch(net, [np.zeros((height, width, 3), dtype=np.uint8)])
@@ -1,75 +1,141 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import onnxruntime
 import numpy as np
 import cv2
 import os
+import threading
 
 from lib.meta import Meta
 
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+def session_options(intra_op_threads: int = 0, inter_op_threads: int = 0, execution_mode: str = None, graph_optimization_level: str = None) -> onnxruntime.SessionOptions:
+    """
+    0 threads or None mode/level means the ONNX Runtime default.
+    inter_op_threads only matters when execution_mode is 'parallel'.
+    """
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads or 0
+    options.inter_op_num_threads = inter_op_threads or 0
+    if execution_mode:
+        options.execution_mode = EXECUTION_MODES[execution_mode]
+    if graph_optimization_level:
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+    return options
+
+def to_bgr(image):
+    """Frames decoded with cv2.IMREAD_UNCHANGED can be grayscale or have an alpha channel."""
+    if image.ndim == 2 or image.shape[2] == 1:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return image
+
 class OnnxNet:
     session: onnxruntime.InferenceSession
     meta: Meta
 
-    def __init__(self, onnx_path: str, meta_path: str, use_gpu: bool):
+    def __init__(self, onnx_path: str, meta_path: str, use_gpu: bool, options: Optional[dict] = None):
         providers = ['CUDAExecutionProvider'] if use_gpu else ['CPUExecutionProvider']
-        self.session = onnxruntime.InferenceSession(onnx_path, providers=providers)
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=session_options(**(options or {})), providers=providers)
         self.meta = Meta(meta_path)
 
-    def detect(self, meta, image, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
-        input_h = self.session.get_inputs()[0].shape[2]
-        input_w = self.session.get_inputs()[0].shape[3]
-        width = image.shape[1]
-        height = image.shape[0]
-
-        # Input
-        resized = cv2.resize(image, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
-        img_in = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
-        img_in = np.transpose(img_in, (2, 0, 1)).astype(np.float32)
-        img_in = np.expand_dims(img_in, axis=0)
-        img_in /= 255.0
-
-        input_name = self.session.get_inputs()[0].name
-        outputs = self.session.run(None, {input_name: img_in})
-
-        detections = post_processing(outputs, width, height, thresh, nms, meta.names)
-        return detections[0]
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_h = model_input.shape[2]
+        self.input_w = model_input.shape[3]
+        # Models exported with a fixed batch dimension can only take that many frames per run
+        self.max_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) and model_input.shape[0] > 0 else None
+
+        # Preprocessing writes into these buffers instead of allocating new arrays for every frame.
+        # The lock keeps them intact while a session run is reading them.
+        self.resized_buffer = np.empty((self.input_h, self.input_w, 3), dtype=np.uint8)
+        self.input_buffer = np.empty((self.max_batch or 1, 3, self.input_h, self.input_w), dtype=np.float32)
+        self.buffer_lock = threading.Lock()
+
+    def preprocess_into(self, image, dest):
+        """Resizes a frame and writes it into `dest` as normalized RGB in CHW layout."""
+        image = to_bgr(image)
+        # resize() only writes into dst when it's the right shape and type for the output. Otherwise it quietly allocates a new array.
+        resized = cv2.resize(image, (self.input_w, self.input_h), dst=self.resized_buffer, interpolation=cv2.INTER_LINEAR)
+        np.divide(resized[:, :, ::-1].transpose(2, 0, 1), np.float32(255.0), out=dest)
+
+    def input_batch(self, batch_size):
+        if self.input_buffer.shape[0] < batch_size:
+            self.input_buffer = np.empty((batch_size, 3, self.input_h, self.input_w), dtype=np.float32)
+        return self.input_buffer[:batch_size]
 
+    def detect(self, meta, image, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
+        return self.detect_batch(meta, [image], alt_names, thresh, hier_thresh, nms, debug)[0]
+
+    def detect_batch(self, meta, images, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False) -> List[List[Tuple[str, float, Tuple[float, float, float, float]]]]:
+        """Runs a single inference over a stack of frames. Frames can be of different sizes."""
+        max_batch = self.max_batch or len(images)
+
+        dets_batch = []
+        with self.buffer_lock:
+            for start in range(0, len(images), max_batch):
+                batch_images = images[start:start + max_batch]
+                img_in = self.input_batch(len(batch_images))
+                for i, image in enumerate(batch_images):
+                    self.preprocess_into(image, img_in[i])
+
+                outputs = self.session.run(None, {self.input_name: img_in})
+                for i, image in enumerate(batch_images):
+                    # Boxes are normalized. Scale each frame with its own dimensions.
+                    dets_batch += post_processing([o[i:i + 1] for o in outputs], image.shape[1], image.shape[0], thresh, nms, meta.names)
+        return dets_batch
+
+
+def batched_nms_cpu(boxes, confs, class_ids, nms_thresh=0.5, min_mode=False):
+    """
+    Greedy NMS for boxes of all classes. Sorts once by (class, confidence), then suppresses within each class.
+    Returns indices of kept boxes, grouped by class, each group in descending order of confidence.
+
+    Still a Python loop with one iteration per kept box, the same algorithm as the per-class nms_cpu it replaces.
+    Only the overlaps of each kept box against the remaining candidates of its class are computed in one numpy op.
+    Class offsets with pairwise overlap matrices per block of candidates measured 0.3x-1.2x of this on the outputs of
+    this model (a single class, and few objects with many candidates clustered around each of them), so they are not used.
+    """
+    if boxes.shape[0] == 0:
+        return np.empty(0, dtype=np.int64)
 
-def nms_cpu(boxes, confs, nms_thresh=0.5, min_mode=False):
-    # print(boxes.shape)
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
     x2 = boxes[:, 2]
     y2 = boxes[:, 3]
-
     areas = (x2 - x1) * (y2 - y1)
-    order = confs.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        idx_self = order[0]
-        idx_other = order[1:]
-
-        keep.append(idx_self)
-
-        xx1 = np.maximum(x1[idx_self], x1[idx_other])
-        yy1 = np.maximum(y1[idx_self], y1[idx_other])
-        xx2 = np.minimum(x2[idx_self], x2[idx_other])
-        yy2 = np.minimum(y2[idx_self], y2[idx_other])
-
-        w = np.maximum(0.0, xx2 - xx1)
-        h = np.maximum(0.0, yy2 - yy1)
-        inter = w * h
 
-        if min_mode:
-            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
-        else:
-            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+    sorted_order = np.lexsort((-confs, class_ids))
+    class_starts = np.flatnonzero(np.diff(class_ids[sorted_order])) + 1
 
-        inds = np.where(over <= nms_thresh)[0]
-        order = order[inds + 1]
-
-    return np.array(keep)
+    keep = []
+    for order in np.split(sorted_order, class_starts):
+        while order.size > 0:
+            i = order[0]
+            others = order[1:]
+            keep.append(i)
+
+            w = np.maximum(0.0, np.minimum(x2[i], x2[others]) - np.maximum(x1[i], x1[others]))
+            h = np.maximum(0.0, np.minimum(y2[i], y2[others]) - np.maximum(y1[i], y1[others]))
+            inter = w * h
+            if min_mode:
+                over = inter / np.minimum(areas[i], areas[others])
+            else:
+                over = inter / (areas[i] + areas[others] - inter)
+            order = others[over <= nms_thresh]
+
+    return np.array(keep, dtype=np.int64)
 
 def post_processing(output, width, height, conf_thresh, nms_thresh, names):
     box_array = output[0]
@@ -79,8 +145,6 @@ def post_processing(output, width, height, conf_thresh, nms_thresh, names):
         box_array = box_array.cpu().detach().numpy()
         confs = confs.cpu().detach().numpy()
 
-    num_classes = confs.shape[2]
-
     # [batch, num, 4]
     box_array = box_array[:, :, 0]
 
@@ -88,45 +152,28 @@ def post_processing(output, width, height, conf_thresh, nms_thresh, names):
     max_conf = np.max(confs, axis=2)
     max_id = np.argmax(confs, axis=2)
 
-    box_x1x1x2y2_to_xcycwh_scaled = lambda b: \
-        (
-            float(0.5 * width * (b[0] + b[2])),
-            float(0.5 * height * (b[1] + b[3])),
-            float(width * (b[2] - b[0])),
-            float(width * (b[3] - b[1]))
-         )
     dets_batch = []
     for i in range(box_array.shape[0]):
-
         argwhere = max_conf[i] > conf_thresh
         l_box_array = box_array[i, argwhere, :]
         l_max_conf = max_conf[i, argwhere]
         l_max_id = max_id[i, argwhere]
 
-        bboxes = []
-        # nms for each class
-        for j in range(num_classes):
-
-            cls_argwhere = l_max_id == j
-            ll_box_array = l_box_array[cls_argwhere, :]
-            ll_max_conf = l_max_conf[cls_argwhere]
-            ll_max_id = l_max_id[cls_argwhere]
-
-            keep = nms_cpu(ll_box_array, ll_max_conf, nms_thresh)
+        keep = batched_nms_cpu(l_box_array, l_max_conf, l_max_id, nms_thresh)
 
-            if (keep.size > 0):
-                ll_box_array = ll_box_array[keep, :]
-                ll_max_conf = ll_max_conf[keep]
-                ll_max_id = ll_max_id[keep]
-
-                for k in range(ll_box_array.shape[0]):
-                    bboxes.append([ll_box_array[k, 0], ll_box_array[k, 1], ll_box_array[k, 2], ll_box_array[k, 3], ll_max_conf[k], ll_max_conf[k], ll_max_id[k]])
-
-        detections = [(names[b[6]], float(b[4]), box_x1x1x2y2_to_xcycwh_scaled((b[0], b[1], b[2], b[3]))) for b in bboxes]
-        dets_batch.append(detections)
+        b = l_box_array[keep]
+        # x1y1x2y2 -> xc, yc, w, h, scaled to image size
+        scaled = np.stack((
+            (b[:, 0] + b[:, 2]).astype(np.float64) * (0.5 * width),
+            (b[:, 1] + b[:, 3]).astype(np.float64) * (0.5 * height),
+            (b[:, 2] - b[:, 0]).astype(np.float64) * width,
+            (b[:, 3] - b[:, 1]).astype(np.float64) * width,
+        ), axis=1)
 
+        dets_batch.append(list(zip(
+            [names[c] for c in l_max_id[keep].tolist()],
+            l_max_conf[keep].tolist(),
+            map(tuple, scaled.tolist()),
+        )))
 
     return dets_batch
-
-
-
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import flask
+import functools
 from flask import request, jsonify
-from os import path, environ
+from os import path, environ, cpu_count
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 import cv2
@@ -10,10 +11,25 @@ import numpy as np
 import requests
 
 from auth import token_required
-from lib.detection_model import load_net, detect
+from lib.detection_model import load_net, detect_batch, warm_up
+from lib.batching import BatchScheduler
 
 THRESH = 0.08  # The threshold for a box to be considered a positive detection
 SESSION_TTL_SECONDS = 60*2
+BATCH_MAX_SIZE = int(environ.get('BATCH_MAX_SIZE', 8))  # Max number of frames fed to the net in one run
+BATCH_MAX_WAIT_MS = float(environ.get('BATCH_MAX_WAIT_MS', 5))  # How long a frame can wait for others to join its batch
+
+# ONNX Runtime session settings. By default each session uses all cores, which oversubscribes the CPU when there are multiple workers.
+ML_API_WORKERS = int(environ.get('ML_API_WORKERS', 1))
+ONNX_INTRA_OP_THREADS = int(environ.get('ONNX_INTRA_OP_THREADS', 0))
+if not ONNX_INTRA_OP_THREADS and ML_API_WORKERS > 1:
+    ONNX_INTRA_OP_THREADS = max(1, (cpu_count() or 1) // ML_API_WORKERS)
+ONNX_OPTIONS = dict(
+    intra_op_threads=ONNX_INTRA_OP_THREADS,
+    inter_op_threads=int(environ.get('ONNX_INTER_OP_THREADS', 0)),
+    execution_mode=environ.get('ONNX_EXECUTION_MODE'),  # sequential | parallel
+    graph_optimization_level=environ.get('ONNX_GRAPH_OPTIMIZATION_LEVEL'),  # disable | basic | extended | all
+)
 
 # Sentry
 if environ.get('SENTRY_DSN'):
@@ -30,18 +46,53 @@ status = dict()
 app.config['DEBUG'] = environ.get('DEBUG') == 'True'
 
 model_dir = path.join(path.dirname(path.realpath(__file__)), 'model')
-net_main = load_net(path.join(model_dir, 'model.cfg'), path.join(model_dir, 'model.meta'))
+net_main = load_net(path.join(model_dir, 'model.cfg'), path.join(model_dir, 'model.meta'), onnx_options=ONNX_OPTIONS)
+warm_up(net_main)
+scheduler = BatchScheduler(
+    lambda images: detect_batch(net_main, images, thresh=THRESH),
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+)
+
+def decode_img(img_bytes):
+    img_array = np.frombuffer(img_bytes, dtype=np.uint8)
+    img = cv2.imdecode(img_array, -1)
+    if img is None:  # Not submitted to the scheduler, so that it can't fail the batch it would have joined
+        raise ValueError('Failed to decode image')
+    return img
+
+def fetch_img(img_url):
+    resp = requests.get(img_url, stream=True, timeout=(0.1, 5))
+    resp.raise_for_status()
+    return decode_img(resp.content)
 
-@app.route('/p/', methods=['GET'])
+def posted_imgs():
+    '''
+    JPEG bytes posted in the request body, either as multipart files named `img`, or as a raw `image/jpeg` body.
+    '''
+    if request.files:
+        return [f.read() for f in request.files.getlist('img')]
+    if request.mimetype == 'image/jpeg':
+        return [request.get_data()]
+    return []
+
+@app.route('/p/', methods=['GET', 'POST'])
 @token_required
 def get_p():
-    if 'img' in request.args:
+    if request.method == 'POST':
+        img_bytes = posted_imgs()
+        if img_bytes:
+            try:
+                detections = scheduler.submit(decode_img(img_bytes[0])).result()
+                return jsonify({'detections': detections})
+            except:
+                sentry_sdk.capture_exception()
+        else:
+            app.logger.warn("Invalid request body: {}".format(request.mimetype))
+    elif 'img' in request.args:
         try:
-            resp = requests.get(request.args['img'], stream=True, timeout=(0.1, 5))
-            resp.raise_for_status()
-            img_array = np.array(bytearray(resp.content), dtype=np.uint8)
-            img = cv2.imdecode(img_array, -1)
-            detections = detect(net_main, img, thresh=THRESH)
+            img = fetch_img(request.args['img'])
+            detections = scheduler.submit(img).result()
             return jsonify({'detections': detections})
         except:
             sentry_sdk.capture_exception()
@@ -51,9 +102,50 @@ def get_p():
     # todo, not a correct way to report an error if exception
     return jsonify({'detections': []})
 
+@app.route('/p/batch/', methods=['GET', 'POST'])
+@token_required
+def get_p_batch():
+    '''
+    Detect on multiple frames in one request: `?img=url1&img=url2...`, POST `{"img": [url1, url2...]}`,
+    or POST multipart files all named `img`.
+    Response is `{"detections": [detections_of_img1, detections_of_img2...]}`.
+    '''
+    img_bytes = posted_imgs() if request.method == 'POST' else []
+    if img_bytes:
+        load_imgs = [functools.partial(decode_img, b) for b in img_bytes]
+    else:
+        img_urls = (request.get_json(silent=True) or {}).get('img') or request.args.getlist('img')
+        load_imgs = [functools.partial(fetch_img, url) for url in img_urls]
+
+    if not load_imgs:
+        app.logger.warn("Invalid request params: {}".format(request.args))
+        return jsonify({'detections': []})
+
+    # All frames are loaded before any is submitted, so that they are run in as few batches as possible
+    imgs = []
+    for load_img in load_imgs:
+        try:
+            imgs.append(load_img())
+        except:
+            sentry_sdk.capture_exception()
+            imgs.append(None)
+
+    submitted = iter(scheduler.submit_many([img for img in imgs if img is not None]))
+    futures = [next(submitted) if img is not None else None for img in imgs]
+
+    detections_batch = []
+    for future in futures:
+        try:
+            detections_batch.append(future.result() if future else [])
+        except:
+            sentry_sdk.capture_exception()
+            detections_batch.append([])
+
+    return jsonify({'detections': detections_batch})
+
 @app.route('/hc/', methods=['GET'])
 def health_check():
     return 'ok' if net_main is not None else 'error'
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=3333, threaded=False)
+    app.run(host='0.0.0.0', port=3333, threaded=True)  # Concurrent requests are coalesced into batches by the scheduler